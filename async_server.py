@@ -0,0 +1,393 @@
+"""
+asyncio implementation of the FHIR GRIP source, using grpc.aio and an
+async, connection pooled HTTP client (httpx, with HTTP/2 when the `h2`
+package is installed). Streams wait on the network without holding a
+thread each, so one process can serve thousands of concurrent streams.
+
+Enabled by setting `ASYNC: true` in config.yaml. Requires
+    pip install httpx
+"""
+
+import asyncio
+import signal
+import time
+import threading
+
+import grpc
+import httpx
+
+import gripper_pb2
+from server import FHIRClient, ResourceCache, UnknownEdgeTable, resource_etag, edgeID, edge_refs, parse_edge_id, add_servicer_to_server, bundle_next
+from search_paths import search_values, path_values
+from struct_codec import encode_row, encode_edge_row
+
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class AsyncFHIRClient:
+    # query building and metadata lookups are shared with the threaded client
+    collection_option = FHIRClient.collection_option
+    search_url = FHIRClient.search_url
+    page_params = FHIRClient.page_params
+    get_resources = FHIRClient.get_resources
+    get_resource_info = FHIRClient.get_resource_info
+    get_search_fields = FHIRClient.get_search_fields
+    search_param = FHIRClient.search_param
+    param_paths = FHIRClient.param_paths
+    _index_metadata = FHIRClient._index_metadata
+    _wants_definitions = FHIRClient._wants_definitions
+
+    def __init__(self, config):
+        self.config = config
+        self.base_url = config["FHIR_API"]
+        headers = {
+            "Content-Type": "application/fhir+json",
+            "accept": "application/fhir+json;charset=utf-8"
+        }
+        auth = None
+        if 'FHIR_COOKIE' in config:
+            headers["cookie"] = "AWSELBAuthSessionCookie-0=%s" % (config["FHIR_COOKIE"])
+        else:
+            auth = (config["FHIR_USER"], config["FHIR_PW"])
+        limit = config.get("FHIR_MAX_CONCURRENCY", 10)
+        self.session = httpx.AsyncClient(headers=headers, auth=auth, http2=HTTP2,
+            timeout=config.get("FHIR_TIMEOUT", 60),
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit))
+        self.inflight = asyncio.Semaphore(limit)
+        self.cache = None
+        if config.get("CACHE_MAX_BYTES", 0) > 0:
+            self.cache = ResourceCache(config["CACHE_MAX_BYTES"])
+        self._index_metadata({})
+
+    async def _get_json(self, url):
+        """Returns the decoded response and its size in bytes"""
+        async with self.inflight:
+            resp = await self.session.get(url)
+        return resp.json(), len(resp.content)
+
+    async def update_metadata(self):
+        data, _ = await self._get_json(self.base_url + "metadata")
+        definitions = None
+        if self._wants_definitions(data):
+            try:
+                params = [("_count", 500), ("_elements", "url,code,base,type,expression")]
+                definitions = [r async for r in self._paginate(self.search_url("SearchParameter", params))]
+            except Exception as e:
+                print("Reading SearchParameter definitions failed: %s" % (e))
+        self._index_metadata(data, definitions)
+
+    async def refresh_metadata(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.update_metadata()
+            except Exception as e:
+                print("Metadata refresh failed: %s" % (e))
+
+    async def _pages(self, url):
+        """Follow the `next` links of a Bundle search, fetching each page
+        while the previous one is consumed"""
+        task = asyncio.ensure_future(self._get_json(url))
+        try:
+            while task is not None:
+                data, size = await task
+                nextURL = bundle_next(data)
+                task = None
+                if nextURL is not None:
+                    task = asyncio.ensure_future(self._get_json(nextURL))
+                yield data.get("entry", []), size
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def _paginate(self, url):
+        async for entries, _ in self._pages(url):
+            for e in entries:
+                yield e['resource']
+
+    async def list_resource(self, name, elements=None):
+        url = self.search_url(name, self.page_params(name, elements))
+        async for r in self._paginate(url):
+            yield r['id'], r
+
+    async def scan_resource(self, res, field, value, elements=None):
+        url = self.search_url(res, [(field, value)] + self.page_params(res, elements))
+        async for r in self._paginate(url):
+            yield r['id'], r
+
+    async def scan_nonempty_field(self, res, field):
+        params = [("%s:missing" % (field), "false")] + self.page_params(res, [field])
+        async for r in self._paginate(self.search_url(res, params)):
+            if field in r:
+                yield r['id'], r[field]
+
+    async def get_entries(self, res, ids):
+        """Fetch a group of resources with a single `_id` search"""
+        out = {}
+        if self.cache is not None:
+            missing = []
+            for i in ids:
+                cached = self.cache.lookup(res, i)
+                if cached is not None and cached[2]:
+                    out[i] = cached[0]
+                else:
+                    missing.append(i)
+            ids = missing
+        ids = list(ids)
+        if len(ids) == 0:
+            return out
+        ttl = self.collection_option(res, "CACHE_TTL", 300)
+        url = self.search_url(res, [("_id", ",".join(ids)), ("_count", len(ids))])
+        async for entries, size in self._pages(url):
+            for e in entries:
+                r = e['resource']
+                if r.get("resourceType", res) == res:
+                    out[r['id']] = r
+                    if self.cache is not None:
+                        self.cache.put(res, r['id'], r, size // len(entries), ttl, resource_etag(r))
+        return out
+
+    async def get_elements(self, res, ids, elements):
+        """Fetch only `elements` of a group of resources, not cached"""
+        out = {}
+        ids = list(ids)
+        params = [("_id", ",".join(ids)), ("_count", len(ids)), ("_elements", ",".join(elements))]
+        async for r in self._paginate(self.search_url(res, params)):
+            if r.get("resourceType", res) == res:
+                out[r['id']] = r
+        return out
+
+    async def close(self):
+        await self.session.aclose()
+
+
+async def batch_requests(request_iterator, size, window):
+    """Async version of server.batch_requests, groups RowRequests into per
+    collection batches of at most `size`, waiting at most `window` seconds"""
+    incoming = asyncio.Queue()
+    async def read():
+        try:
+            async for req in request_iterator:
+                await incoming.put(req)
+        finally:
+            await incoming.put(None)
+    reader = asyncio.ensure_future(read())
+
+    pending = {}
+    deadlines = {}
+    try:
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines.values()) - time.monotonic())
+            try:
+                req = await asyncio.wait_for(incoming.get(), timeout)
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                for c in [c for c, t in deadlines.items() if t <= now]:
+                    del deadlines[c]
+                    yield c, pending.pop(c)
+                continue
+            if req is None:
+                for c in list(pending):
+                    yield c, pending.pop(c)
+                return
+            batch = pending.setdefault(req.collection, [])
+            if not batch:
+                deadlines[req.collection] = time.monotonic() + window
+            batch.append(req)
+            if len(batch) >= size:
+                del deadlines[req.collection]
+                yield req.collection, pending.pop(req.collection)
+    finally:
+        reader.cancel()
+
+
+class AsyncFHIRServicer:
+    def __init__(self, fhir, schema, config={}):
+        self.fhir = fhir
+        self.schema = schema
+        self.batch_size = config.get("BATCH_SIZE", 100)
+        self.batch_window = config.get("BATCH_WINDOW", 0.005)
+        self.lookup_concurrency = config.get("ROWS_BY_ID_CONCURRENCY", 1)
+        self.edge_id_mode = config.get("EDGE_ID_MODE", "fetch")
+        if self.edge_id_mode not in ("fetch", "verify", "trust"):
+            raise ValueError("Unknown EDGE_ID_MODE: %s" % (self.edge_id_mode))
+
+    async def GetCollections(self, request, context):
+        for i in self.fhir.get_resources():
+            yield gripper_pb2.Collection(name=i)
+        for e in self.schema.get_edges():
+            yield gripper_pb2.Collection(name=e)
+
+    async def _edge_table(self, name, context):
+        try:
+            return self.schema.edge_table(name)
+        except UnknownEdgeTable:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "Unknown edge table: %s" % (name))
+
+    async def GetCollectionInfo(self, request, context):
+        o = gripper_pb2.CollectionInfo()
+        if request.name.endswith(":edges"):
+            t = await self._edge_table(request.name, context)
+            o.search_fields.extend(["$." + t.src, "$." + t.dst])
+            return o
+        o.search_fields.extend(self.fhir.get_search_fields(request.name))
+        return o
+
+    async def GetIDs(self, request, context):
+        if request.name.endswith(":edges"):
+            t = await self._edge_table(request.name, context)
+            async for i, field in self.fhir.scan_nonempty_field(t.src, t.edge):
+                for _, _, dst_id in edge_refs(t, field):
+                    yield gripper_pb2.RowID(id=edgeID(t.src,t.edge,t.dst,i,dst_id))
+        else:
+            async for i, e in self.fhir.list_resource(request.name, elements=["id"]):
+                yield gripper_pb2.RowID(id=i)
+
+    async def GetRows(self, request, context):
+        if request.name.endswith(":edges"):
+            t = await self._edge_table(request.name, context)
+            async for i, field in self.fhir.scan_nonempty_field(t.src, t.edge):
+                for _, _, dst_id in edge_refs(t, field):
+                    yield encode_edge_row(edgeID(t.src,t.edge,t.dst,i,dst_id), t.src, i, t.dst, dst_id)
+        else:
+            async for i, e in self.fhir.list_resource(request.name):
+                yield encode_row(i, e)
+
+    async def GetRowsByID(self, request_iterator, context):
+        # batches are resolved concurrently, and rows returned as each
+        # batch completes
+        done = asyncio.Queue()
+        slots = asyncio.Semaphore(max(1, self.lookup_concurrency))
+        pending = set()
+        async def resolve(collection, reqs):
+            try:
+                await done.put(await self._rows_by_id(collection, reqs))
+            except Exception as e:
+                await done.put(e)
+            finally:
+                slots.release()
+        async def submit():
+            count = 0
+            try:
+                async for collection, reqs in batch_requests(request_iterator, self.batch_size, self.batch_window):
+                    await slots.acquire()
+                    task = asyncio.ensure_future(resolve(collection, reqs))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    count += 1
+            finally:
+                await done.put(count)
+        submitter = asyncio.ensure_future(submit())
+
+        try:
+            total = None
+            received = 0
+            while total is None or received < total:
+                rows = await done.get()
+                if isinstance(rows, UnknownEdgeTable):
+                    await context.abort(grpc.StatusCode.NOT_FOUND, "Unknown edge table: %s" % (rows.args[0]))
+                if isinstance(rows, Exception):
+                    raise rows
+                if isinstance(rows, int):
+                    total = rows
+                    continue
+                received += 1
+                for o in rows:
+                    yield o
+        finally:
+            submitter.cancel()
+            for task in pending:
+                task.cancel()
+
+    async def _rows_by_id(self, collection, reqs):
+        out = []
+        if collection.endswith(":edges"):
+            t = self.schema.edge_table(collection)
+            edges = []
+            for req in reqs:
+                e = parse_edge_id(t, req.id)
+                if e is not None:
+                    edges.append((req, e))
+            if self.edge_id_mode != "trust":
+                srcIds = set(e[0] for _, e in edges)
+                if self.edge_id_mode == "verify":
+                    docs = await self.fhir.get_elements(t.src, srcIds, [t.edge])
+                else:
+                    docs = await self.fhir.get_entries(t.src, srcIds)
+                found = set((srcId, dstRes, dstId) for srcId, d in docs.items()
+                    for _, dstRes, dstId in edge_refs(t, d.get(t.edge, [])))
+                edges = [(req, e) for req, e in edges if e in found]
+            for req, (srcId, dstRes, dstId) in edges:
+                out.append(encode_edge_row(req.id, t.src, srcId, dstRes, dstId, req.requestID))
+        else:
+            docs = await self.fhir.get_entries(collection, set(req.id for req in reqs))
+            for req in reqs:
+                d = docs.get(req.id)
+                if d is not None:
+                    out.append(encode_row(req.id, d, req.requestID))
+        return out
+
+    async def GetRowsByField(self, req, context):
+        field = req.field[2:] if req.field.startswith("$.") else req.field
+        if req.collection.endswith(":edges"):
+            t = await self._edge_table(req.collection, context)
+            srcRes, edge, dstRes = t.src, t.edge, t.dst
+            values = req.value.split(",")
+            if field == srcRes:
+                docs = await self.fhir.get_elements(srcRes, values, [edge])
+                for srcId, d in docs.items():
+                    for _, eDstRes, dstId in edge_refs(t, d.get(edge, [])):
+                        yield encode_edge_row(edgeID(srcRes,edge,eDstRes,srcId,dstId),
+                            srcRes, srcId, eDstRes, dstId)
+            elif field == dstRes:
+                if t.typed:
+                    docs = self.fhir.scan_resource(srcRes, "%s:%s" % (edge, dstRes),
+                        ",".join(v.split("/")[-1] for v in values), elements=[edge])
+                else:
+                    docs = self.fhir.scan_resource(srcRes, edge, req.value, elements=[edge])
+                async for srcId, d in docs:
+                    for eDst, eDstRes, dstId in edge_refs(t, d.get(edge, [])):
+                        if eDst in values or dstId in values:
+                            yield encode_edge_row(edgeID(srcRes,edge,eDstRes,srcId,dstId),
+                                srcRes, srcId, eDstRes, dstId)
+        else:
+            param = self.fhir.search_param(req.collection, field)
+            if param is None:
+                # no search parameter reads this path, filter a scan here
+                values = set(req.value.split(","))
+                async for i, e in self.fhir.list_resource(req.collection):
+                    if set(search_values(path_values(e, field))) & values:
+                        yield encode_row(i, e)
+                return
+            async for i, e in self.fhir.scan_resource(req.collection, param, req.value):
+                yield encode_row(i, e)
+
+
+async def serve_async(port, config, schema):
+    client = AsyncFHIRClient(config)
+    await client.update_metadata()
+    if config.get("METADATA_REFRESH", 0) > 0:
+        refresh = asyncio.ensure_future(client.refresh_metadata(config["METADATA_REFRESH"]))
+    # `kill -HUP` reloads the CapabilityStatement, signal handlers can only
+    # be set from the main thread
+    if threading.current_thread() is threading.main_thread():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP,
+            lambda: asyncio.ensure_future(client.update_metadata()))
+    server = grpc.aio.server()
+    add_servicer_to_server(AsyncFHIRServicer(client, schema, config), server)
+    server.add_insecure_port('[::]:%s' % port)
+    await server.start()
+    print("Serving (async): %s" % (port))
+    try:
+        await server.wait_for_termination()
+    finally:
+        await client.close()
+
+def serve(port, config, schema):
+    asyncio.run(serve_async(port, config, schema))
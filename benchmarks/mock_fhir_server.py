@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Mock FHIR server for benchmarks, serving synthetic Patient, Group,
+Observation and Condition resources with configurable latency and page
+size. Condition.subject references either a Patient or a Group.
+
+Supports the parts of the FHIR REST API the GRIP source uses: metadata,
+reads, SearchParameter definitions, searches on `_id` and the parameters
+in SEARCH_PARAMS (with comma separated values, `:missing` and type
+modifiers), `_include`, `_revinclude`, `_count`, `_elements`, `_offset`,
+`_sort` on `_lastUpdated` or `_id`, `_lastUpdated` ranges,
+`_summary=count`, paging through `next` links and a Bulk Data `$export`
+serving NDJSON.
+
+    ./benchmarks/mock_fhir_server.py --port 8080 --patients 1000 --latency 0.05
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# name, type, FHIRPath expression and the element it reads
+SEARCH_PARAMS = {
+    "Patient": [("gender", "token", "Patient.gender", "gender"),
+        ("identifier", "token", "Patient.identifier", "identifier"),
+        ("birthdate", "date", "Patient.birthDate", "birthDate")],
+    "Group": [("type", "token", "Group.type", "type")],
+    "Observation": [("subject", "reference", "Observation.subject", "subject"),
+        ("patient", "reference", "Observation.subject.where(resolve() is Patient)", "subject"),
+        ("code", "token", "Observation.code", "code"),
+        ("status", "token", "Observation.status", "status"),
+        ("specimen", "reference", "Observation.specimen", "specimen"),
+        ("value-quantity", "quantity", "(Observation.value as Quantity)", "valueQuantity")],
+    "Condition": [("subject", "reference", "Condition.subject", "subject"),
+        ("code", "token", "Condition.code", "code")],
+}
+
+
+def generate(patients, observations, conditions, seed=0):
+    """Synthetic resources, keyed by type then id"""
+    rnd = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    def meta():
+        t = start + timedelta(seconds=rnd.randint(0, 365 * 24 * 3600))
+        return {"versionId": "1", "lastUpdated": t.strftime("%Y-%m-%dT%H:%M:%S.000Z")}
+    data = {"Patient": {}, "Group": {}, "Observation": {}, "Condition": {}}
+    groups = max(patients // 100, 1)
+    for i in range(groups):
+        id = "g%d" % (i)
+        data["Group"][id] = {"resourceType": "Group", "id": id, "meta": meta(),
+            "type": "person", "actual": True}
+    for i in range(patients):
+        id = "p%d" % (i)
+        data["Patient"][id] = {
+            "resourceType": "Patient", "id": id, "meta": meta(),
+            "identifier": [{"system": "urn:mock:participant", "value": "PT_%06d" % (i)}],
+            "gender": rnd.choice(["male", "female", "unknown"]),
+            "birthDate": "%d-%02d-%02d" % (rnd.randint(1940, 2015), rnd.randint(1, 12), rnd.randint(1, 28))
+        }
+    codes = [("718-7", "Hemoglobin"), ("2345-7", "Glucose"), ("8302-2", "Body height"), ("29463-7", "Body weight")]
+    for i in range(observations):
+        id = "o%d" % (i)
+        code, display = rnd.choice(codes)
+        data["Observation"][id] = {
+            "resourceType": "Observation", "id": id, "meta": meta(), "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+            "subject": {"reference": "Patient/p%d" % (rnd.randrange(max(patients, 1)))},
+            "effectiveDateTime": "2019-05-14T09:30:00Z",
+            "valueQuantity": {"value": round(rnd.uniform(1, 200), 1), "unit": "1"}
+        }
+    for i in range(conditions):
+        id = "c%d" % (i)
+        data["Condition"][id] = {
+            "resourceType": "Condition", "id": id, "meta": meta(),
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": str(rnd.randint(1000, 1100))}]},
+            "subject": {"reference": "Patient/p%d" % (rnd.randrange(max(patients, 1)))}
+        }
+        # a fifth of conditions are on a Group, for polymorphic references
+        if rnd.random() < 0.2:
+            data["Condition"][id]["subject"] = {"reference": "Group/g%d" % (rnd.randrange(groups))}
+    return data
+
+
+def search_values(x, modifier=None):
+    out = []
+    for e in x if isinstance(x, list) else [x]:
+        if isinstance(e, dict):
+            if "reference" in e:
+                if modifier and not e["reference"].startswith(modifier + "/"):
+                    continue
+                out.append(e["reference"])
+                out.append(e["reference"].split("/")[-1])
+            for c in e.get("coding", []):
+                out.append(c.get("code"))
+            if "value" in e:
+                out.append(str(e["value"]))
+        else:
+            out.append(str(e))
+    return out
+
+
+def search_parameter(name, type, expression, res):
+    return {"resourceType": "SearchParameter", "id": "%s-%s" % (res, name),
+        "url": "http://mock/SearchParameter/%s-%s" % (res, name),
+        "code": name, "base": [res], "type": type, "expression": expression}
+
+
+def matches(r, key, value):
+    if key == "_id":
+        return r["id"] in value.split(",")
+    if key == "_lastUpdated":
+        lu = datetime.fromisoformat(r["meta"]["lastUpdated"].replace("Z", "+00:00"))
+        t = datetime.fromisoformat(value[2:].replace("Z", "+00:00"))
+        return {"gt": lu > t, "ge": lu >= t, "lt": lu < t, "le": lu <= t}[value[:2]]
+    name, _, modifier = key.partition(":")
+    paths = dict((n, path) for n, _, _, path in SEARCH_PARAMS.get(r["resourceType"], []))
+    name = paths.get(name, name)
+    if modifier == "missing":
+        return (name not in r) == (value == "true")
+    if name not in r:
+        return False
+    found = search_values(r[name], modifier or None)
+    return any(v in found for v in value.split(","))
+
+
+class MockFHIR:
+    def __init__(self, data, latency=0.0, page_size=50):
+        self.data = data
+        self.latency = latency
+        self.page_size = page_size
+        self.requests = 0
+        self.exports = {}
+
+    def capability(self):
+        return {
+            "resourceType": "CapabilityStatement",
+            "rest": [{
+                "mode": "server",
+                "operation": [{"name": "export"}],
+                "resource": [{
+                    "type": t,
+                    "searchParam": [{"name": "_id", "type": "token"}] +
+                        [{"name": n, "type": k, "definition": "http://mock/SearchParameter/%s-%s" % (t, n)}
+                            for n, k, _, _ in SEARCH_PARAMS.get(t, [])]
+                } for t in self.data] + [{"type": "SearchParameter"}]
+            }]
+        }
+
+    def search(self, base, res, query):
+        count = self.page_size
+        offset = 0
+        elements = None
+        sort = None
+        summary = None
+        includes = []
+        revincludes = []
+        filters = []
+        for k, v in query:
+            if k == "_count":
+                count = int(v)
+            elif k in ("_offset", "_getpagesoffset"):
+                offset = int(v)
+            elif k == "_elements":
+                elements = set(v.split(",")) | {"resourceType", "id", "meta"}
+            elif k == "_sort":
+                sort = v
+            elif k == "_summary":
+                summary = v
+            elif k == "_include":
+                includes.append(v.split(":"))
+            elif k == "_revinclude":
+                revincludes.append(v.split(":"))
+            elif not k.startswith("_") or k in ("_id", "_lastUpdated"):
+                filters.append((k, v))
+        found = [r for r in self.data.get(res, {}).values() if all(matches(r, k, v) for k, v in filters)]
+        if summary == "count":
+            return {"resourceType": "Bundle", "type": "searchset", "total": len(found)}
+        if sort is not None:
+            key = (lambda r: r["id"]) if sort.lstrip("-") == "_id" else (lambda r: r["meta"]["lastUpdated"])
+            found.sort(key=key, reverse=sort.startswith("-"))
+        page = found[offset:offset + count]
+        if elements is not None:
+            page = [{k: v for k, v in r.items() if k in elements} for r in page]
+        entries = [{"resource": r, "search": {"mode": "match"}} for r in page]
+        included = {}
+        for r in page:
+            for src, field, *target in includes:
+                if r["resourceType"] == src:
+                    for ref in search_values(r.get(field, []), target[0] if target else None):
+                        t, _, id = ref.partition("/")
+                        if id in self.data.get(t, {}):
+                            included[ref] = self.data[t][id]
+            for src, field in revincludes:
+                ref = "%s/%s" % (r["resourceType"], r["id"])
+                for i in self.data.get(src, {}).values():
+                    if ref in search_values(i.get(field, [])):
+                        included["%s/%s" % (src, i["id"])] = i
+        entries.extend({"resource": r, "search": {"mode": "include"}} for r in included.values())
+        links = [{"relation": "self", "url": base + res + "?" + urllib.parse.urlencode(query)}]
+        if offset + count < len(found):
+            q = [(k, v) for k, v in query if k not in ("_offset", "_getpagesoffset")]
+            q.append(("_getpagesoffset", str(offset + count)))
+            links.append({"relation": "next", "url": base + res + "?" + urllib.parse.urlencode(q)})
+        return {"resourceType": "Bundle", "type": "searchset", "total": len(found),
+            "link": links, "entry": entries}
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, without this each
+        # response waits on a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, code, body=b"", headers={}, content_type="application/fhir+json"):
+            if isinstance(body, dict):
+                body = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            mock.requests += 1
+            if mock.latency:
+                time.sleep(mock.latency)
+            base = "http://%s/" % (self.headers["Host"])
+            url = urllib.parse.urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            query = urllib.parse.parse_qsl(url.query)
+            if parts == ["metadata"]:
+                return self.send(200, mock.capability())
+            if parts == ["$export"]:
+                types = dict(query).get("_type", ",".join(mock.data)).split(",")
+                job = str(len(mock.exports))
+                mock.exports[job] = types
+                return self.send(202, headers={"Content-Location": base + "_export/" + job})
+            if len(parts) == 2 and parts[0] == "_export":
+                output = [{"type": t, "url": base + "_export/%s/%s.ndjson" % (parts[1], t)} for t in mock.exports[parts[1]]]
+                return self.send(200, {"transactionTime": datetime.now(timezone.utc).isoformat(),
+                    "request": base + "$export", "requiresAccessToken": False, "output": output, "error": []},
+                    content_type="application/json")
+            if len(parts) == 3 and parts[0] == "_export":
+                t = parts[2].split(".")[0]
+                body = "\n".join(json.dumps(r) for r in mock.data.get(t, {}).values()).encode("utf-8")
+                return self.send(200, body, content_type="application/fhir+ndjson")
+            if parts == ["SearchParameter"]:
+                return self.send(200, {"resourceType": "Bundle", "type": "searchset", "entry": [
+                    {"resource": search_parameter(n, k, e, t)} for t, ps in SEARCH_PARAMS.items() for n, k, e, _ in ps]})
+            if len(parts) == 1 and parts[0] in mock.data:
+                return self.send(200, mock.search(base, parts[0], query))
+            if len(parts) == 2 and parts[0] in mock.data:
+                r = mock.data[parts[0]].get(parts[1])
+                if r is None:
+                    return self.send(404, {"resourceType": "OperationOutcome"})
+                etag = 'W/"%s"' % (r["meta"]["versionId"])
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send(304, headers={"ETag": etag})
+                return self.send(200, r, headers={"ETag": etag})
+            return self.send(404, {"resourceType": "OperationOutcome"})
+    return Handler
+
+
+def start(mock, port=0):
+    """Run the mock server on a background thread, returns the HTTP server"""
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), make_handler(mock))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--observations", type=int, default=10000)
+    parser.add_argument("--conditions", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--page-size", type=int, default=50, help="default page size of searches")
+    args = parser.parse_args()
+    data = generate(args.patients, args.observations, args.conditions)
+    httpd = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(MockFHIR(data, args.latency, args.page_size)))
+    print("Mock FHIR server: http://127.0.0.1:%d/" % (args.port))
+    httpd.serve_forever()
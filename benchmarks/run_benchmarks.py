@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+End to end benchmarks of the GRIP source. Starts the mock FHIR server
+(benchmarks/mock_fhir_server.py) in a separate process, serves a
+FHIRServicer over gRPC on a local port and times each RPC pattern from a
+gRPC client, reporting rows/sec, p50/p99 latency and FHIR requests made
+for each, and the peak RSS of the whole run, as JSON.
+
+    ./benchmarks/run_benchmarks.py --latency 0.02 --output results.json
+    ./benchmarks/run_benchmarks.py --config tuning.yaml
+
+Options in the `--config` file are passed to FHIRClient and FHIRServicer
+as they would be from config.yaml, so runs with different tuning options
+can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import yaml
+import socket
+import random
+import argparse
+import resource
+import subprocess
+import urllib.request
+from concurrent import futures
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import grpc
+import metrics
+import gripper_pb2
+import gripper_pb2_grpc
+from server import FHIRClient, FHIRServicer, Schema, add_servicer_to_server
+
+SCHEMA = {"edges": {"Observation": {"subject": "Patient"}, "Condition": {"subject": ["Group", "Patient"]}}}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_mock(args):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_fhir_server.py"),
+        "--port", str(port), "--patients", str(args.patients), "--observations", str(args.observations),
+        "--conditions", str(args.conditions), "--latency", str(args.latency),
+        "--page-size", str(args.page_size)], stdout=subprocess.DEVNULL)
+    url = "http://127.0.0.1:%d/" % (port)
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(url + "metadata").read()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Mock FHIR server did not start")
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def fhir_requests():
+    return sum(metrics.FHIR_STATUS.values.values())
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. It is the high water mark of the
+    # process since it started, client included, so it is only reported once
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def measure(name, calls):
+    """Run `calls`, a list of functions returning (rows, latencies), and
+    summarize them"""
+    requests = fhir_requests()
+    rows = 0
+    latencies = []
+    start = time.monotonic()
+    for call in calls:
+        n, lat = call()
+        rows += n
+        latencies.extend(lat)
+    elapsed = time.monotonic() - start
+    out = {
+        "name": name,
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "fhir_requests": fhir_requests() - requests
+    }
+    print("%-34s %8d rows %9.1f rows/s  p50 %8s ms  p99 %8s ms  %6d FHIR requests" % (
+        name, rows, out["rows_per_sec"] or 0, out["p50_ms"], out["p99_ms"], out["fhir_requests"]))
+    return out
+
+def stream_call(method, request):
+    """Latency of the whole call"""
+    def call():
+        start = time.monotonic()
+        n = sum(1 for _ in method(request))
+        return n, [time.monotonic() - start]
+    return call
+
+def scan_call(method, request):
+    """Latency between rows of a long stream, the p99 shows page stalls"""
+    def call():
+        latencies = []
+        last = time.monotonic()
+        for _ in method(request):
+            now = time.monotonic()
+            latencies.append(now - last)
+            last = now
+        return len(latencies), latencies
+    return call
+
+def rows_by_id_call(stub, collection, ids):
+    """Latency from sending each RowRequest to receiving its row"""
+    def call():
+        sent = {}
+        def requests():
+            for n, i in enumerate(ids):
+                sent[n + 1] = time.monotonic()
+                yield gripper_pb2.RowRequest(collection=collection, id=i, requestID=n + 1)
+        latencies = []
+        for row in stub.GetRowsByID(requests()):
+            latencies.append(time.monotonic() - sent[row.requestID])
+        return len(latencies), latencies
+    return call
+
+class RawStub:
+    """Stream methods returning the serialized messages, so the client's
+    time decoding Structs isn't counted against the server"""
+    def __init__(self, channel):
+        self.GetIDs = self._method(channel, "GetIDs", gripper_pb2.Collection)
+        self.GetRows = self._method(channel, "GetRows", gripper_pb2.Collection)
+        self.GetRowsByField = self._method(channel, "GetRowsByField", gripper_pb2.FieldRequest)
+
+    def _method(self, channel, name, request):
+        return channel.unary_stream("/gripper.GRIPSource/" + name,
+            request_serializer=request.SerializeToString, response_deserializer=None)
+
+def run(args, stub, raw):
+    rnd = random.Random(1)
+    patients = ["p%d" % (rnd.randrange(args.patients)) for _ in range(args.queries)]
+    observations = ["o%d" % (rnd.randrange(args.observations)) for _ in range(args.queries)]
+    lookups = ["p%d" % (rnd.randrange(args.patients)) for _ in range(args.lookups)]
+    edges = "Observation:subject:edges"
+    results = []
+    for _ in range(args.repeat):
+        results.append(measure("GetRows Observation",
+            [scan_call(raw.GetRows, gripper_pb2.Collection(name="Observation"))]))
+        results.append(measure("GetIDs Observation",
+            [scan_call(raw.GetIDs, gripper_pb2.Collection(name="Observation"))]))
+        results.append(measure("GetRows " + edges,
+            [scan_call(raw.GetRows, gripper_pb2.Collection(name=edges))]))
+        results.append(measure("GetRowsByID Patient",
+            [rows_by_id_call(stub, "Patient", lookups)]))
+        results.append(measure("GetRowsByField edge src",
+            [stream_call(raw.GetRowsByField, gripper_pb2.FieldRequest(collection=edges, field="$.Observation", value=i))
+                for i in observations]))
+        results.append(measure("GetRowsByField edge dst",
+            [stream_call(raw.GetRowsByField, gripper_pb2.FieldRequest(collection=edges, field="$.Patient", value=i))
+                for i in patients]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--observations", type=int, default=10000)
+    parser.add_argument("--conditions", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds the mock server adds to every request")
+    parser.add_argument("--page-size", type=int, default=50, help="page size of the mock server")
+    parser.add_argument("--lookups", type=int, default=1000, help="ids sent in the GetRowsByID stream")
+    parser.add_argument("--queries", type=int, default=100, help="GetRowsByField calls per edge side")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--config", help="YAML file of servicer options, as in config.yaml")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as handle:
+            config = yaml.load(handle, Loader=yaml.SafeLoader) or {}
+    proc, url = start_mock(args)
+    try:
+        config.update({"FHIR_API": url, "FHIR_USER": "bench", "FHIR_PW": "bench"})
+        client = FHIRClient(config)
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=100))
+        add_servicer_to_server(FHIRServicer(client, Schema(SCHEMA), config), server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        server.start()
+        channel = grpc.insecure_channel("127.0.0.1:%d" % (port))
+        results = run(args, gripper_pb2_grpc.GRIPSourceStub(channel), RawStub(channel))
+        channel.close()
+        server.stop(None)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    report = {
+        "settings": {k: v for k, v in vars(args).items() if k not in ("config", "output")},
+        "config": {k: v for k, v in config.items() if k not in ("FHIR_API", "FHIR_USER", "FHIR_PW")},
+        "results": results,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+    print("peak RSS of the run, servicer and client, %.1f MB" % (report["peak_rss_mb"]))
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of turning FHIR resources into serialized Rows, comparing
+json_format.ParseDict followed by SerializeToString (what gRPC does with a
+Row message) against the struct_codec encoder.
+
+    ./benchmarks/struct_conversion.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gripper_pb2
+import struct_codec
+from google.protobuf import json_format
+
+PATIENT = {
+    "resourceType": "Patient",
+    "id": "452974",
+    "meta": {"versionId": "3", "lastUpdated": "2021-03-05T18:12:44.120+00:00",
+        "profile": ["https://ncpi-fhir.github.io/ncpi-fhir-ig/StructureDefinition/ncpi-patient"]},
+    "identifier": [
+        {"system": "https://kf-api-dataservice.kidsfirstdrc.org/participants?external_id=", "value": "PT_1X2Y3Z4W"},
+        {"use": "official", "system": "urn:kids-first:participant", "value": "PT_1X2Y3Z4W"}],
+    "extension": [
+        {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+         "extension": [
+            {"url": "ombCategory", "valueCoding": {"system": "urn:oid:2.16.840.1.113883.6.238",
+                "code": "2106-3", "display": "White"}},
+            {"url": "text", "valueString": "White"}]},
+        {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity",
+         "extension": [
+            {"url": "ombCategory", "valueCoding": {"system": "urn:oid:2.16.840.1.113883.6.238",
+                "code": "2186-5", "display": "Not Hispanic or Latino"}},
+            {"url": "text", "valueString": "Not Hispanic or Latino"}]}],
+    "active": True,
+    "gender": "female",
+    "birthDate": "1998-07-01",
+    "deceasedBoolean": False
+}
+
+OBSERVATION = {
+    "resourceType": "Observation",
+    "id": "457520",
+    "meta": {"versionId": "1", "lastUpdated": "2021-03-05T18:20:01.512+00:00"},
+    "identifier": [{"system": "urn:kids-first:phenotype", "value": "PH_ABCD1234"}],
+    "status": "final",
+    "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+        "code": "laboratory", "display": "Laboratory"}]}],
+    "code": {"coding": [{"system": "http://loinc.org", "code": "718-7",
+        "display": "Hemoglobin [Mass/volume] in Blood"}], "text": "Hemoglobin"},
+    "subject": {"reference": "Patient/452974"},
+    "effectiveDateTime": "2019-05-14T09:30:00-05:00",
+    "issued": "2019-05-14T13:02:11.000-05:00",
+    "valueQuantity": {"value": 13.2, "unit": "g/dL", "system": "http://unitsofmeasure.org", "code": "g/dL"},
+    "interpretation": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
+        "code": "N", "display": "Normal"}]}],
+    "referenceRange": [{"low": {"value": 12, "unit": "g/dL"}, "high": {"value": 16, "unit": "g/dL"},
+        "appliesTo": [{"text": "female"}]}],
+    "note": [{"text": "Specimen slightly hemolyzed"}],
+    "hasMember": [],
+    "dataAbsentReason": None
+}
+
+EDGE = ("Observation", "457520", "Patient", "452974")
+
+def parse_dict(d):
+    o = gripper_pb2.Row()
+    o.id = d['id']
+    json_format.ParseDict(d, o.data)
+    return o.SerializeToString()
+
+def fast(d):
+    return struct_codec.encode_row(d['id'], d)
+
+def parse_dict_edge():
+    o = gripper_pb2.Row()
+    o.id = "edge"
+    o.requestID = 7
+    json_format.ParseDict({EDGE[0]: EDGE[1], EDGE[2]: EDGE[3]}, o.data)
+    return o.SerializeToString()
+
+def fast_edge():
+    return struct_codec.encode_edge_row("edge", *EDGE, requestID=7)
+
+def same(a, b):
+    return gripper_pb2.Row.FromString(a) == gripper_pb2.Row.FromString(b)
+
+def report(name, baseline, candidate, n):
+    b = min(timeit.repeat(baseline, number=n, repeat=3)) / n * 1e6
+    c = min(timeit.repeat(candidate, number=n, repeat=3)) / n * 1e6
+    print("%-12s ParseDict %8.1f us   struct_codec %8.1f us   speedup %.1fx" % (name, b, c, b / c))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, res in [("Patient", PATIENT), ("Observation", OBSERVATION)]:
+        assert same(parse_dict(res), fast(res)), "conversion mismatch for %s" % (name)
+        report(name, lambda: parse_dict(res), lambda: fast(res), n)
+    assert same(parse_dict_edge(), fast_edge())
+    report("edge", parse_dict_edge, fast_edge, n)
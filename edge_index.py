@@ -0,0 +1,119 @@
+"""
+Local SQLite index of the edge tables defined in the schema. Edges are
+stored as (src_id, dst_type, dst_id) rows per source type and edge field,
+indexed in both directions, so edge listings and reverse lookups don't
+need to page through the FHIR server.
+"""
+
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+
+class EdgeIndex:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS edges (
+            src_type TEXT, edge TEXT, src_id TEXT, dst_type TEXT, dst_id TEXT)""")
+        db.execute("CREATE INDEX IF NOT EXISTS edges_src ON edges (src_type, edge, src_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS edges_dst ON edges (src_type, edge, dst_id)")
+        db.execute("""CREATE TABLE IF NOT EXISTS synced (
+            src_type TEXT, edge TEXT, last_sync TEXT, PRIMARY KEY (src_type, edge))""")
+        db.commit()
+        self.indexed = set(db.execute("SELECT src_type, edge FROM synced"))
+
+    def _db(self):
+        # sqlite connections can't be shared between threads, so each
+        # reader gets its own
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path)
+        return self.local.db
+
+    def is_indexed(self, src, edge):
+        return (src, edge) in self.indexed
+
+    def _select(self, where, args, dst_type):
+        q = "SELECT src_id, dst_type, dst_id FROM edges WHERE " + where
+        if dst_type is not None:
+            q += " AND dst_type=?"
+            args = args + (dst_type,)
+        return self._db().execute(q, args)
+
+    def edges(self, src, edge, dst_type=None):
+        """Yields (src_id, dst_type, dst_id) for every edge in the table,
+        or only the edges to `dst_type`"""
+        return self._select("src_type=? AND edge=?", (src, edge), dst_type)
+
+    def by_src(self, src, edge, src_id, dst_type=None):
+        return self._select("src_type=? AND edge=? AND src_id=?", (src, edge, src_id), dst_type)
+
+    def by_dst(self, src, edge, dst_id, dst_type=None):
+        return self._select("src_type=? AND edge=? AND dst_id=?", (src, edge, dst_id), dst_type)
+
+    def refresh(self, fhir, src, edge, overlap=300):
+        """Bring the index of one edge table up to date. The first refresh
+        loads the whole table, later ones only re-read source resources with
+        a `_lastUpdated` after the previous sync (less `overlap` seconds, to
+        allow for clock skew)"""
+        started = datetime.now(timezone.utc)
+        with self.write_lock:
+            db = self._db()
+            row = db.execute("SELECT last_sync FROM synced WHERE src_type=? AND edge=?",
+                (src, edge)).fetchone()
+            if row is None:
+                db.execute("DELETE FROM edges WHERE src_type=? AND edge=?", (src, edge))
+                for src_id, field in fhir.scan_nonempty_field(src, edge):
+                    self._insert(db, src, edge, src_id, field)
+            else:
+                since = datetime.fromisoformat(row[0]) - timedelta(seconds=overlap)
+                for src_id, r in fhir.scan_updated(src, since, elements=[edge]):
+                    db.execute("DELETE FROM edges WHERE src_type=? AND edge=? AND src_id=?",
+                        (src, edge, src_id))
+                    if edge in r:
+                        self._insert(db, src, edge, src_id, r[edge])
+            db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?, ?)",
+                (src, edge, started.isoformat()))
+            db.commit()
+        self.indexed.add((src, edge))
+
+    def _insert(self, db, src, edge, src_id, field):
+        rows = []
+        for f in field if isinstance(field, list) else [field]:
+            if 'reference' in f:
+                dst_type, dst_id = f['reference'].split("/")[:2]
+                rows.append((src, edge, src_id, dst_type, dst_id))
+        db.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?)", rows)
+
+    def rebuild(self):
+        """Drop sync state so the next refresh reloads every table, this picks
+        up deleted source resources, which incremental refreshes can't see"""
+        with self.write_lock:
+            db = self._db()
+            db.execute("DELETE FROM synced")
+            db.commit()
+
+    def start_refresh(self, fhir, schema, interval, rebuild=None):
+        """Refresh all edge tables now, then every `interval` seconds, on a
+        background thread. With `rebuild` set, every table is reloaded in
+        full once that many seconds have passed since the last full load"""
+        stop = threading.Event()
+        def run():
+            rebuilt = time.monotonic()
+            while True:
+                if rebuild and time.monotonic() - rebuilt >= rebuild:
+                    self.rebuild()
+                    rebuilt = time.monotonic()
+                for src, edge in schema.get_edge_fields():
+                    try:
+                        self.refresh(fhir, src, edge)
+                    except Exception as e:
+                        print("Edge index refresh of %s:%s failed: %s" % (src, edge, e))
+                if stop.wait(interval):
+                    return
+        threading.Thread(target=run, daemon=True).start()
+        return stop
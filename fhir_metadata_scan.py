@@ -1,25 +1,40 @@
 #!/usr/bin/env python
+"""
+Discover the edges of the FHIR server by sampling the reference fields of
+each resource type, and write schema.yaml and graph_model.yaml.
+
+(resource, searchParam) pairs are probed concurrently, reading only the
+reference field. Probing a pair stops once `--settle` references in a row
+add no new destination type. Fields referencing several types are listed
+with all of them, and get an edge per destination type in the graph
+model. With `--incremental` the previous schema.yaml is reused, and only
+types whose reference searchParams changed since it was written are
+probed again.
+"""
 
-import sys
 import json
 import yaml
+import hashlib
+import argparse
 import requests
+from concurrent import futures
+from requests.adapters import HTTPAdapter
+
+
+def new_session(config, workers):
+    session = requests.session()
+    session.headers = {
+        "Content-Type": "application/fhir+json",
+        "accept": "application/fhir+json;charset=utf-8"
+    }
+    session.headers["cookie"] = f"AWSELBAuthSessionCookie-0=%s" % (config["FHIR_COOKIE"])
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-with open("config.yaml") as handle:
-    config = yaml.load(handle, Loader=yaml.SafeLoader)
-session = requests.session()
-session.headers = {
-    "Content-Type": "application/fhir+json",
-    "accept": "application/fhir+json;charset=utf-8"
-}
-session.headers["cookie"] = f"AWSELBAuthSessionCookie-0=%s" % (config["FHIR_COOKIE"])
-
-resp = session.get(config["FHIR_API"] + "metadata")
-metadata = resp.json()
-
-def get_edge_list(resType, field, limit=100):
-    url = config['FHIR_API'] + resType + "?%s:missing=false&_elements=%s" % (field, field)
-    #url = config['FHIR_API'] + resType + "?%s:missing=false" % (field)
+def get_edge_list(session, base, resType, field, limit=100, page_size=25):
+    url = base + resType + "?%s:missing=false&_elements=%s&_count=%d" % (field, field, page_size)
     resp = session.get(url)
     data = resp.json()
     count = 0
@@ -44,57 +59,139 @@ def force_list(x):
     else:
         return [x]
 
-nodes = []
-edges = {}
-for r in metadata['rest']:
-    for res in r['resource']:
-        src = res['type']
-        print("Checking %s" % (src))
-        nodes.append(src)
-        for param in res['searchParam']:
-            if param['type'] == "reference":
-                edge = param['name']
-                dstSet = set()
-                for dst in get_edge_list(src, edge):
-                    for d in force_list(dst):
-                        if 'reference' in d:
-                            tmp = d['reference'].split("/")
-                            dstSet.add(tmp[0])
-                if len(dstSet) == 1:
-                    o = edges.get(src, {})
-                    o[edge] = list(dstSet)[0]
-                    edges[src] = o
-
-with open("schema.yaml", "w") as handle:
-    handle.write(yaml.dump({"edges" : edges}))
-
-model = {
-    "sources": {"fhir": {"host": "localhost:50051"}},
-    "vertices" : {},
-    "edges" : {}
-}
-
-for n in nodes:
-    model["vertices"][n + "/"] = {
-        "source": "fhir",
-        "label": n,
-        "collection": n
+def probe(session, base, src, edge, limit, page_size, settle):
+    """Destination types of the references in one field, sampling at most
+    `limit` resources, and stopping once `settle` references in a row
+    found no new type"""
+    dstSet = set()
+    unchanged = 0
+    for dst in get_edge_list(session, base, src, edge, limit, page_size):
+        for d in force_list(dst):
+            if 'reference' in d:
+                tmp = d['reference'].split("/")
+                if tmp[0] in dstSet:
+                    unchanged += 1
+                else:
+                    dstSet.add(tmp[0])
+                    unchanged = 0
+        if unchanged >= settle:
+            break
+    return dstSet
+
+def reference_params(res):
+    return [p for p in res.get('searchParam', []) if p['type'] == "reference"]
+
+def fingerprint(res):
+    """Hash of the reference searchParams of a type, edges only need to be
+    probed again when it changes"""
+    params = sorted(reference_params(res), key=lambda p: p['name'])
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def scan(session, base, metadata, previous, workers, limit, page_size, settle):
+    """Returns the list of resource types, the edges and the fingerprints
+    of each type. Types with the same fingerprint as in `previous` (an
+    earlier schema.yaml) keep their edges without being probed"""
+    nodes = []
+    edges = {}
+    fingerprints = {}
+    oldPrints = previous.get("fingerprints", {})
+    oldEdges = previous.get("edges", {})
+    jobs = {}
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for r in metadata['rest']:
+            for res in r['resource']:
+                src = res['type']
+                nodes.append(src)
+                fingerprints[src] = fingerprint(res)
+                if oldPrints.get(src) == fingerprints[src]:
+                    if src in oldEdges:
+                        edges[src] = oldEdges[src]
+                    continue
+                print("Checking %s" % (src))
+                for param in reference_params(res):
+                    edge = param['name']
+                    jobs[pool.submit(probe, session, base, src, edge, limit, page_size, settle)] = (src, edge)
+        for f in futures.as_completed(jobs):
+            src, edge = jobs[f]
+            dstSet = f.result()
+            if len(dstSet) == 1:
+                edges.setdefault(src, {})[edge] = list(dstSet)[0]
+            elif len(dstSet) > 1:
+                # polymorphic references get one edge table per destination type
+                edges.setdefault(src, {})[edge] = sorted(dstSet)
+    # keep the output stable, whatever order the probes finished in
+    edges = {src: dict(sorted(edges[src].items())) for src in sorted(edges)}
+    return nodes, edges, fingerprints
+
+def graph_model(nodes, edges):
+    model = {
+        "sources": {"fhir": {"host": "localhost:50051"}},
+        "vertices" : {},
+        "edges" : {}
     }
 
-for src in edges:
-    for edge, dst in edges[src].items():
-        model['edges']["%s-%s" % (src, edge)] = {
-            "fromVertex": src + "/",
-            "toVertex": dst + "/",
-            "label": edge,
-            "edgeTable": {
-              "source": "fhir",
-              "collection": "%s:%s:edges" % (src, edge),
-              "fromField": "$." + src,
-              "toField": "$." + dst
-             }
+    for n in nodes:
+        model["vertices"][n + "/"] = {
+            "source": "fhir",
+            "label": n,
+            "collection": n
         }
 
+    for src in edges:
+        for edge, dst in edges[src].items():
+            if isinstance(dst, list):
+                for d in dst:
+                    model['edges']["%s-%s-%s" % (src, edge, d)] = edge_model(src, edge, d,
+                        "%s:%s:%s:edges" % (src, edge, d))
+            else:
+                model['edges']["%s-%s" % (src, edge)] = edge_model(src, edge, dst,
+                    "%s:%s:edges" % (src, edge))
+    return model
+
+def edge_model(src, edge, dst, collection):
+    return {
+        "fromVertex": src + "/",
+        "toVertex": dst + "/",
+        "label": edge,
+        "edgeTable": {
+          "source": "fhir",
+          "collection": collection,
+          "fromField": "$." + src,
+          "toField": "$." + dst
+         }
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--schema", default="schema.yaml", help="schema file to write, and read with --incremental")
+    parser.add_argument("--model", default="graph_model.yaml")
+    parser.add_argument("--workers", type=int, default=8, help="(resource, searchParam) pairs probed concurrently")
+    parser.add_argument("--limit", type=int, default=100, help="max resources sampled per pair")
+    parser.add_argument("--page-size", type=int, default=25, help="_count of each probe search")
+    parser.add_argument("--settle", type=int, default=20,
+        help="stop probing a pair after this many references in a row found no new destination type")
+    parser.add_argument("--incremental", action="store_true",
+        help="reuse the edges in --schema of types whose searchParams have not changed")
+    args = parser.parse_args()
+
+    with open(args.config) as handle:
+        config = yaml.load(handle, Loader=yaml.SafeLoader)
+    previous = {}
+    if args.incremental:
+        try:
+            with open(args.schema) as handle:
+                previous = yaml.load(handle, Loader=yaml.SafeLoader) or {}
+        except FileNotFoundError:
+            pass
+    session = new_session(config, args.workers)
+    metadata = session.get(config["FHIR_API"] + "metadata").json()
+    nodes, edges, fingerprints = scan(session, config["FHIR_API"], metadata, previous,
+        args.workers, args.limit, args.page_size, args.settle)
+
+    with open(args.schema, "w") as handle:
+        handle.write(yaml.dump({"edges" : edges, "fingerprints": fingerprints}))
 
-with open("graph_model.yaml", "w") as handle:
-    handle.write(yaml.dump(model, sort_keys=False))
+    with open(args.model, "w") as handle:
+        handle.write(yaml.dump(graph_model(nodes, edges), sort_keys=False))
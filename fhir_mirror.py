@@ -0,0 +1,155 @@
+"""
+Local materialized copy of selected FHIR collections. Resources are stored
+as JSON in SQLite, with a secondary index on the values of the search
+parameters the server advertises for each collection, so reads and simple
+field searches can be answered without calling the FHIR server.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+from search_paths import EXACT_TYPES, search_values, path_values
+
+
+class FHIRMirror:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS resources (
+            type TEXT, id TEXT, data TEXT, PRIMARY KEY (type, id))""")
+        db.execute("""CREATE TABLE IF NOT EXISTS params (
+            type TEXT, name TEXT, value TEXT, id TEXT)""")
+        db.execute("CREATE INDEX IF NOT EXISTS params_value ON params (type, name, value)")
+        db.execute("CREATE INDEX IF NOT EXISTS params_id ON params (type, id)")
+        db.execute("""CREATE TABLE IF NOT EXISTS synced (
+            type TEXT PRIMARY KEY, last_sync TEXT)""")
+        db.commit()
+        self.synced = set(r[0] for r in db.execute("SELECT type FROM synced"))
+        self.params = {}
+        # parameter types of each collection, known once it has been synced
+        self.types = {}
+        for t, name in db.execute("SELECT DISTINCT type, name FROM params"):
+            self.params.setdefault(t, set()).add(name)
+
+    def _db(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path)
+        return self.local.db
+
+    def has(self, res):
+        return res in self.synced
+
+    def can_search(self, res, field):
+        """A search can only be answered locally if values were indexed for
+        the parameter, and the values match exactly: `_id`, and token and
+        reference parameters with no modifier but a resource type, e.g.
+        `subject:Patient`. Anything else has to go to the FHIR server"""
+        name, _, modifier = field.partition(":")
+        if res not in self.synced or name not in self.params.get(res, ()):
+            return False
+        if name == "_id":
+            return modifier == ""
+        if self.types.get(res, {}).get(name) not in EXACT_TYPES:
+            return False
+        return modifier == "" or (self.types[res][name] == "reference" and modifier[:1].isupper())
+
+    def list(self, res):
+        for id, data in self._db().execute("SELECT id, data FROM resources WHERE type=?", (res,)):
+            yield id, json.loads(data)
+
+    def get(self, res, ids):
+        out = {}
+        ids = list(ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            q = "SELECT id, data FROM resources WHERE type=? AND id IN (%s)" % (",".join("?" * len(chunk)))
+            for id, data in self._db().execute(q, [res] + chunk):
+                out[id] = json.loads(data)
+        return out
+
+    def search(self, res, field, value):
+        values = value.split(",")
+        q = """SELECT id, data FROM resources WHERE type=? AND id IN
+            (SELECT id FROM params WHERE type=? AND name=? AND value IN (%s))""" % (",".join("?" * len(values)))
+        for id, data in self._db().execute(q, [res, res, field] + values):
+            yield id, json.loads(data)
+
+    def _store(self, db, res, params, resource):
+        id = resource['id']
+        db.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?)",
+            (res, id, json.dumps(resource)))
+        db.execute("DELETE FROM params WHERE type=? AND id=?", (res, id))
+        rows = [(res, "_id", id, id)]
+        for p, paths in params.items():
+            values = set()
+            for path in paths:
+                values.update(search_values(path_values(resource, path)))
+            for v in values:
+                rows.append((res, p, v, id))
+        db.executemany("INSERT INTO params VALUES (?, ?, ?, ?)", rows)
+        return set(r[1] for r in rows)
+
+    def sync(self, fhir, res, overlap=300):
+        """Load a collection, or on later calls re-read the resources updated
+        since the previous sync (less `overlap` seconds for clock skew)"""
+        started = datetime.now(timezone.utc)
+        info = fhir.get_resource_info(res) or {}
+        # values are read from the elements the server's definition of each
+        # parameter points at
+        params = {p['name']: fhir.param_paths(res, p['name'])
+            for p in info.get("searchParam", []) if not p['name'].startswith("_")}
+        types = {p['name']: p.get("type") for p in info.get("searchParam", [])}
+        found = set()
+        with self.write_lock:
+            db = self._db()
+            row = db.execute("SELECT last_sync FROM synced WHERE type=?", (res,)).fetchone()
+            if row is None:
+                db.execute("DELETE FROM resources WHERE type=?", (res,))
+                db.execute("DELETE FROM params WHERE type=?", (res,))
+                resources = fhir.scan_collection(res)
+            else:
+                since = datetime.fromisoformat(row[0]) - timedelta(seconds=overlap)
+                resources = fhir.scan_updated(res, since)
+            for _, r in resources:
+                found.update(self._store(db, res, params, r))
+            db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (res, started.isoformat()))
+            db.commit()
+        self.params.setdefault(res, set()).update(found)
+        self.types[res] = types
+        self.synced.add(res)
+
+    def rebuild(self):
+        """Drop sync state so the next sync reloads every collection, this
+        drops resources deleted on the server, which incremental syncs can't
+        see. The old copy is served until the reload of each collection commits"""
+        with self.write_lock:
+            db = self._db()
+            db.execute("DELETE FROM synced")
+            db.commit()
+
+    def start_sync(self, fhir, collections, interval, rebuild=None):
+        """Sync the collections now, then every `interval` seconds, on a
+        background thread. With `rebuild` set, every collection is reloaded
+        in full once that many seconds have passed since the last full load"""
+        stop = threading.Event()
+        def run():
+            rebuilt = time.monotonic()
+            while True:
+                if rebuild and time.monotonic() - rebuilt >= rebuild:
+                    self.rebuild()
+                    rebuilt = time.monotonic()
+                for res in collections:
+                    try:
+                        self.sync(fhir, res)
+                    except Exception as e:
+                        print("Mirror sync of %s failed: %s" % (res, e))
+                if stop.wait(interval):
+                    return
+        threading.Thread(target=run, daemon=True).start()
+        return stop
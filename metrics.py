@@ -0,0 +1,196 @@
+"""
+Minimal Prometheus style metrics for the servicer and the FHIR client,
+served in the text exposition format on a local HTTP port
+(`METRICS_PORT` in config.yaml).
+"""
+
+import time
+import functools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REGISTRY = []
+
+def _labels(names, values):
+    if len(names) == 0:
+        return ""
+    return "{%s}" % (",".join('%s="%s"' % (n, v) for n, v in zip(names, values)))
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, value=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + _labels(self.labels, k), v) for k, v in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def dec(self, value=1, *labels):
+        self.inc(-value, *labels)
+
+class CallbackGauge:
+    """Gauge whose samples are read from a function at scrape time, the
+    function returns a dict of label values tuple to value"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, func):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.func = func
+        REGISTRY.append(self)
+
+    def samples(self):
+        return [(self.name + _labels(self.labels, k), v) for k, v in self.func().items()]
+
+class Histogram:
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                for b, c in zip(self.buckets, counts):
+                    out.append((self.name + "_bucket" + _labels(self.labels + ("le",), labels + (b,)), c))
+                out.append((self.name + "_bucket" + _labels(self.labels + ("le",), labels + ("+Inf",)), count))
+                out.append((self.name + "_sum" + _labels(self.labels, labels), total))
+                out.append((self.name + "_count" + _labels(self.labels, labels), count))
+        return out
+
+def render():
+    lines = []
+    for m in REGISTRY:
+        lines.append("# HELP %s %s" % (m.name, m.help))
+        lines.append("# TYPE %s %s" % (m.name, m.kind))
+        for name, value in m.samples():
+            lines.append("%s %s" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+RPC_LATENCY = Histogram("grip_rpc_duration_seconds", "Time to complete a GRIPSource RPC", ("method",))
+RPC_ROWS = Counter("grip_rpc_rows_total", "Messages streamed back by GRIPSource RPCs", ("method",))
+RPC_BYTES = Counter("grip_rpc_bytes_total", "Serialized size of messages returned by GRIPSource RPCs", ("method",))
+RPC_ERRORS = Counter("grip_rpc_errors_total", "GRIPSource RPCs that raised an error", ("method",))
+RPC_IN_FLIGHT = Gauge("grip_rpc_in_flight", "GRIPSource RPCs currently running", ("method",))
+FHIR_LATENCY = Histogram("fhir_request_duration_seconds", "Time until the FHIR server sent response headers")
+FHIR_STATUS = Counter("fhir_responses_total", "FHIR server responses by status code", ("status",))
+FHIR_IN_FLIGHT = Gauge("fhir_requests_in_flight", "Requests currently waiting on the FHIR server")
+FHIR_PAGES = Counter("fhir_pages_total", "Bundle pages read from the FHIR server")
+FHIR_BYTES = Counter("fhir_page_bytes_total", "Size of Bundle pages read from the FHIR server")
+
+
+def _size(msg):
+    if isinstance(msg, bytes):
+        return len(msg)
+    return msg.ByteSize()
+
+def instrument_rpc(func):
+    """Record latency, message counts, sizes and errors of a servicer method,
+    streaming methods are timed until their last message is sent"""
+    method = func.__name__
+    @functools.wraps(func)
+    def unary(self, request, context):
+        RPC_IN_FLIGHT.inc(1, method)
+        start = time.monotonic()
+        try:
+            out = func(self, request, context)
+            RPC_ROWS.inc(1, method)
+            RPC_BYTES.inc(_size(out), method)
+            return out
+        except Exception:
+            RPC_ERRORS.inc(1, method)
+            raise
+        finally:
+            RPC_IN_FLIGHT.dec(1, method)
+            RPC_LATENCY.observe(time.monotonic() - start, method)
+    @functools.wraps(func)
+    def stream(self, request, context):
+        RPC_IN_FLIGHT.inc(1, method)
+        start = time.monotonic()
+        try:
+            for o in func(self, request, context):
+                RPC_ROWS.inc(1, method)
+                RPC_BYTES.inc(_size(o), method)
+                yield o
+        except Exception:
+            RPC_ERRORS.inc(1, method)
+            raise
+        finally:
+            RPC_IN_FLIGHT.dec(1, method)
+            RPC_LATENCY.observe(time.monotonic() - start, method)
+    if method == "GetCollectionInfo":
+        return unary
+    return stream
+
+def watch_client(fhir):
+    """Export the resource cache and connection pool counters of a FHIRClient"""
+    def cache():
+        if fhir.cache is None:
+            return {}
+        s = fhir.cache.stats()
+        out = {(k,): v for k, v in s.items()}
+        lookups = s["hits"] + s["misses"]
+        out[("hit_ratio",)] = s["hits"] / lookups if lookups else 0
+        return out
+    CallbackGauge("fhir_cache", "Resource cache counters", ("stat",), cache)
+    CallbackGauge("fhir_connections", "HTTP connection pool counters", ("stat",),
+        lambda: {(k,): v for k, v in fhir.connection_stats().items()})
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port):
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,159 @@
+"""
+Checkpoints of collection scans, so a GetRows or GetIDs stream that broke
+can be resumed where it stopped instead of from the first page. At the
+start of each Bundle page a cursor records where every partition of the
+scan would continue from, with the number of rows the call had sent by
+then. A client resuming says how many rows it received, and the scan
+continues from the last checkpoint before that, so rows are sent at least
+once. Cursors are held in memory, and from their first checkpoint also
+written to a directory when one is given, so they survive a restart of the
+server. Expired cursor files are deleted as new ones are written.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import collections
+
+# Put in a scan by FHIRClient._paginate before the entries of each page,
+# and with `url` None once a partition has no more pages. `remaining` is
+# the number of resources the partition may still return, None for no limit
+ScanMark = collections.namedtuple("ScanMark", ["part", "url", "remaining"])
+
+
+class ScanCursor:
+    def __init__(self, store, token, key, parts=None):
+        self.store = store
+        self.token = token
+        self.key = key
+        # partition -> [url, remaining] of the page being read, None once
+        # the partition is done
+        self.parts = {k: v and list(v) for k, v in (parts or {}).items()}
+        self.sent = 0
+        self.history = []
+        if parts:
+            self._checkpoint()
+
+    def resuming(self):
+        return len(self.parts) > 0
+
+    def start(self, parts):
+        """Record the partitions of a new scan, as {part: (url, remaining)}"""
+        self.parts = {str(k): list(v) for k, v in parts.items()}
+        self._checkpoint()
+
+    def remaining(self):
+        """Partitions left to read, as {part: (url, remaining)}"""
+        return {k: tuple(v) for k, v in self.parts.items() if v is not None}
+
+    def follow(self, items):
+        """Pass the resources of a scan through, checkpointing at the marks.
+        A mark is only read once the consumer has taken every resource
+        before it"""
+        for x in items:
+            if isinstance(x, ScanMark):
+                self._mark(x)
+            else:
+                yield x
+
+    def counted(self, rows):
+        """Pass the rows of the call through, counting them"""
+        for o in rows:
+            self.sent += 1
+            yield o
+
+    def _mark(self, mark):
+        part = str(mark.part)
+        current = self.parts.get(part)
+        if mark.url is not None and current is not None and current[0] == mark.url:
+            # the page already recorded, or more of a page parsed as it streams
+            return
+        self.parts[part] = None if mark.url is None else [mark.url, mark.remaining]
+        self._checkpoint()
+
+    def _checkpoint(self):
+        self.history.append((self.sent, {k: v and list(v) for k, v in self.parts.items()}))
+        del self.history[:-self.store.history]
+        self.store.save(self)
+
+
+class CursorStore:
+    def __init__(self, directory=None, ttl=86400, history=50):
+        self.directory = directory
+        self.ttl = ttl
+        self.history = history
+        self.cursors = {}
+        self.lock = threading.Lock()
+        self.swept = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def new(self, key):
+        """A cursor for a new call, kept in memory until its first checkpoint"""
+        cursor = ScanCursor(self, uuid.uuid4().hex, key)
+        self._keep(cursor.token, {"key": key, "history": [], "saved": time.time()})
+        return cursor
+
+    def resume(self, token, key, rows=None):
+        """The cursor saved under `token`, continuing after the first `rows`
+        rows of the call that made it, or from its last checkpoint. None if
+        it is unknown, expired, or was made for another request. Raises
+        ValueError if the checkpoint for `rows` is no longer kept"""
+        state = self._load(token)
+        if state is None or state['key'] != key or time.time() - state['saved'] > self.ttl:
+            return None
+        history = state['history']
+        if len(history) == 0:
+            return ScanCursor(self, token, key)
+        if rows is None:
+            return ScanCursor(self, token, key, history[-1][1])
+        found = [parts for sent, parts in history if sent <= rows]
+        if len(found) == 0:
+            raise ValueError("the oldest checkpoint kept is at row %d" % (history[0][0]))
+        return ScanCursor(self, token, key, found[-1])
+
+    def save(self, cursor):
+        state = {"key": cursor.key, "history": cursor.history, "saved": time.time()}
+        self._keep(cursor.token, state)
+        if self.directory is not None:
+            path = os.path.join(self.directory, cursor.token + ".json")
+            with open(path + ".tmp", "w") as handle:
+                json.dump(state, handle)
+            os.replace(path + ".tmp", path)
+            self._sweep(state['saved'])
+
+    def _keep(self, token, state):
+        with self.lock:
+            self.cursors[token] = state
+            for t in [t for t, s in self.cursors.items() if state['saved'] - s['saved'] > self.ttl]:
+                del self.cursors[t]
+
+    def _sweep(self, now):
+        """Delete the expired cursor files, at most once a minute"""
+        with self.lock:
+            if now - self.swept < 60:
+                return
+            self.swept = now
+        for name in os.listdir(self.directory):
+            if not re.fullmatch(r'[0-9a-f]{32}\.json(\.tmp)?', name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self, token):
+        with self.lock:
+            state = self.cursors.get(token)
+        if state is None and self.directory is not None and re.fullmatch(r'[0-9a-f]{32}', token):
+            try:
+                with open(os.path.join(self.directory, token + ".json")) as handle:
+                    state = json.load(handle)
+            except (OSError, ValueError):
+                return None
+        return state
@@ -0,0 +1,163 @@
+"""
+Mapping between element paths in resources (the `$.code.coding.code`
+fields GRIP asks for) and the search parameters the FHIR server indexes.
+Built from the FHIRPath expressions of the server's SearchParameter
+definitions, or, when those aren't available, from the parameter names.
+"""
+
+import re
+
+# elements of parameters that apply to every resource type
+COMMON_PATHS = {
+    "_id": ["id"],
+    "_lastUpdated": ["meta.lastUpdated"],
+    "_tag": ["meta.tag"],
+    "_profile": ["meta.profile"],
+    "_security": ["meta.security"],
+}
+
+# sub elements a search of each type also matches on, e.g. a token search
+# on `code` matches `code.coding.code`
+SUB_PATHS = {
+    "token": ["coding", "coding.code", "code", "value"],
+    "reference": ["reference"],
+    "quantity": ["value"],
+}
+
+# search parameter types whose matches are plain values, so a result can be
+# matched here by comparing the values indexed for it. String searches match
+# prefixes, dates, numbers and quantities match ranges
+EXACT_TYPES = ("token", "reference")
+
+
+def element_name(param):
+    """Best guess at the element a search parameter reads, 'birth-date' -> 'birthDate'"""
+    return re.sub(r'-([a-z])', lambda m: m.group(1).upper(), param)
+
+def search_values(x):
+    """Values a search on an element would match, covering references,
+    codings, identifiers and primitives"""
+    if isinstance(x, list):
+        out = []
+        for i in x:
+            out.extend(search_values(i))
+        return out
+    if isinstance(x, dict):
+        out = []
+        if 'reference' in x:
+            out.append(x['reference'])
+            out.append(x['reference'].split("/")[-1])
+        if 'coding' in x:
+            out.extend(search_values(x['coding']))
+        if 'code' in x:
+            out.append(str(x['code']))
+            if 'system' in x:
+                out.append("%s|%s" % (x['system'], x['code']))
+        if 'value' in x and not isinstance(x['value'], (dict, list)):
+            out.append(str(x['value']))
+            if 'system' in x:
+                out.append("%s|%s" % (x['system'], x['value']))
+        return out
+    if isinstance(x, bool):
+        return [str(x).lower()]
+    return [str(x)]
+
+def normalize_path(path):
+    """'$.code.coding[0].code' -> 'code.coding.code'"""
+    path = re.sub(r'^\$\.', '', path)
+    return re.sub(r'\[[^\]]*\]', '', path)
+
+def path_values(resource, path):
+    """Values at a dotted element path, lists along the way are flattened"""
+    found = [resource]
+    for name in normalize_path(path).split("."):
+        inner = []
+        for f in found:
+            if isinstance(f, dict) and name in f:
+                v = f[name]
+                inner.extend(v if isinstance(v, list) else [v])
+        found = inner
+    return found
+
+def expression_paths(expression, res):
+    """Element paths of a FHIRPath search expression for resource type
+    `res`. Returns the paths, and whether any of them were narrowed by a
+    `where()` clause. Parts that aren't plain paths are skipped"""
+    paths = []
+    narrowed = False
+    for part in expression.split("|"):
+        part = part.strip()
+        while part.startswith("(") and part.endswith(")"):
+            part = part[1:-1].strip()
+        if ".where(" in part:
+            part = part[:part.index(".where(")]
+            narrowed = True
+        # choice types, `Observation.value as Quantity` or `.as(Quantity)`
+        m = re.fullmatch(r'\(?([\w.]+)\)?\s+as\s+(\w+)', part) or re.fullmatch(r'([\w.]+)\.as\((\w+)\)', part)
+        if m is not None:
+            part = m.group(1) + m.group(2)[0].upper() + m.group(2)[1:]
+        if not re.fullmatch(r'[\w.]+', part):
+            continue
+        base, _, path = part.partition(".")
+        if base in (res, "Resource", "DomainResource") and path:
+            paths.append(path)
+    return paths, narrowed
+
+
+class SearchPathIndex:
+    def __init__(self, resources, definitions=None):
+        """`resources` maps resource types to their CapabilityStatement
+        entries, `definitions` is a list of SearchParameter resources"""
+        byURL = {}
+        byCode = {}
+        for sp in definitions or []:
+            if 'url' in sp:
+                byURL[sp['url']] = sp
+            for base in sp.get("base", []):
+                byCode[(base, sp.get("code"))] = sp
+        self.params = {}
+        self.fields = {}
+        self.types = {}
+        for res, info in resources.items():
+            params = {}
+            types = {}
+            fields = {}
+            narrowed = {}
+            for p in info.get("searchParam", []):
+                name = p['name']
+                sp = byURL.get(p.get("definition")) or byCode.get((res, name))
+                paths = []
+                if sp is not None and sp.get("expression"):
+                    paths, narrowed[name] = expression_paths(sp['expression'], res)
+                if not paths:
+                    paths = COMMON_PATHS.get(name, [element_name(name)])
+                params[name] = paths
+                types[name] = p.get("type")
+                for path in paths:
+                    for sub in [""] + SUB_PATHS.get(p.get("type"), []):
+                        fields.setdefault(path + ("." + sub if sub else ""), []).append(name)
+            # a parameter named like the element wins, then the ones that
+            # aren't narrowed to a subset of the element's values
+            for path, names in fields.items():
+                names.sort(key=lambda n: (n != path, narrowed.get(n, False)))
+                fields[path] = names[0]
+            self.params[res] = params
+            self.fields[res] = fields
+            self.types[res] = types
+
+    def resolve(self, res, field):
+        """Search parameter to use for a field, None if no parameter covers
+        it. Parameter names, with modifiers, are passed through"""
+        params = self.params.get(res, {})
+        if field.split(":")[0] in params:
+            return field
+        return self.fields.get(res, {}).get(normalize_path(field))
+
+    def type(self, res, param):
+        """Type of a search parameter, `token`, `string`, ..., None if unknown"""
+        return self.types.get(res, {}).get(param.split(":")[0])
+
+    def paths(self, res, param):
+        """Element paths a search parameter reads"""
+        name = param.split(":")[0]
+        return self.params.get(res, {}).get(name) or COMMON_PATHS.get(name, [element_name(name)])
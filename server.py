@@ -2,18 +2,36 @@
 
 import re
 import sys
+import time
 import yaml
 import json
+import codecs
+import queue
+import signal
+import weakref
+import threading
 import requests
+import itertools
+import urllib.parse
+import collections
+import contextlib
+from datetime import datetime, timezone
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from concurrent import futures
 
 import grpc
 import gripper_pb2
 import gripper_pb2_grpc
+import metrics
+from edge_index import EdgeIndex
+from fhir_mirror import FHIRMirror
+from search_paths import SearchPathIndex, EXACT_TYPES, search_values, path_values
+from scan_cursors import CursorStore, ScanMark
 
-from google.protobuf import json_format
+from struct_codec import encode_row, encode_edge_row
 
 def read_all(resourceTypes):
     """Load all data to the FHIR server."""
@@ -23,105 +41,1025 @@ def read_all(resourceTypes):
         entity = get(_config.connection, url)
         assert entity, f"{url} should return entity"
 
+try:
+    # urllib3 only decodes brotli when the brotli package is installed
+    import brotli
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+Page = collections.namedtuple("Page", ["url", "entries", "size"])
+
+# per call search settings: extra search parameters, a row limit, and an
+# Event that is set once the caller has gone away
+SearchOptions = collections.namedtuple("SearchOptions", ["params", "limit", "cancel", "cursor"])
+NO_OPTIONS = SearchOptions([], None, None, None)
+
+class PrefetchBudget:
+    """Bytes of page data prefetched by the partitions of one scan, which
+    share the `max_bytes` cap"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.cond = threading.Condition()
+
+class Prefetcher:
+    """Drain an iterator of Pages on a background thread, keeping up to
+    `depth` pages buffered ahead of the consumer, while the pages held by
+    every prefetcher sharing the `budget` are under its cap. A prefetcher
+    with nothing buffered may always read one page, so partitions of a
+    scan can't starve each other"""
+    def __init__(self, pages, depth, budget):
+        self.pages = pages
+        self.depth = depth
+        self.budget = budget
+        self.buffer = collections.deque()
+        self.size = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.cond = budget.cond
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _has_room(self):
+        if self.closed:
+            return True
+        return len(self.buffer) < self.depth and (len(self.buffer) == 0 or self.budget.size < self.budget.max_bytes)
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(self._has_room)
+                    if self.closed:
+                        break
+                page = next(self.pages, None)
+                if page is None:
+                    break
+                with self.cond:
+                    if self.closed:
+                        break
+                    self.buffer.append(page)
+                    self.size += page.size
+                    self.budget.size += page.size
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.pages.close()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.buffer or self.done)
+                    if self.buffer:
+                        page = self.buffer.popleft()
+                        self.size -= page.size
+                        self.budget.size -= page.size
+                        self.cond.notify_all()
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                yield page
+        finally:
+            with self.cond:
+                self.closed = True
+                # pages never read give their share of the budget back
+                self.budget.size -= self.size
+                self.size = 0
+                self.buffer.clear()
+                self.cond.notify_all()
+
+def merge_iterators(iterators, maxsize=1000):
+    """Drain several iterators on background threads, yielding their items
+    in the order they arrive"""
+    out = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+    def put(x):
+        while not stop.is_set():
+            try:
+                out.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def drain(it):
+        try:
+            for x in it:
+                if not put((x, None)):
+                    break
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+            put((done, None))
+    for it in iterators:
+        threading.Thread(target=drain, args=(it,), daemon=True).start()
+
+    try:
+        running = len(iterators)
+        while running:
+            x, err = out.get()
+            if err is not None:
+                raise err
+            if x is done:
+                running -= 1
+            else:
+                yield x
+    finally:
+        stop.set()
+
+class SharedScan:
+    """One pass over a generator, shared by every reader that joins it.
+    Items are kept in a buffer of up to `max_items`, readers joining later
+    replay it from the start. Once the buffer is full the items every
+    reader has passed are dropped, after which no one else can join, and
+    the pass waits for the slowest reader. A finished pass can be joined
+    until it has been dropped, or for `ttl` seconds. The pass begins with
+    `start()`"""
+    def __init__(self, items, max_items, ttl):
+        self.source = items
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = []
+        self.base = 0
+        self.readers = weakref.WeakSet()
+        self.finished = None
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def start(self):
+        """Start the pass, returns its first reader. The reader is registered
+        before anything is read, so a source longer than the buffer can't
+        close the pass before anyone has joined"""
+        reader = self.join()
+        threading.Thread(target=self._run, daemon=True).start()
+        return reader
+
+    def _trim(self):
+        """Drop the items every reader has passed, returns how many"""
+        if len(self.readers) == 0:
+            return 0
+        n = min(r.pos for r in self.readers) - self.base
+        del self.items[:n]
+        self.base += n
+        return n
+
+    def _run(self):
+        try:
+            for item in self.source:
+                with self.cond:
+                    while len(self.items) >= self.max_items and self._trim() == 0:
+                        if len(self.readers) == 0:
+                            # everyone has gone, and the start can't be replayed
+                            self.closed = True
+                            return
+                        # readers that are dropped without finishing don't
+                        # notify, so check again now and then
+                        self.cond.wait(1)
+                    self.items.append(item)
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.source.close()
+            with self.cond:
+                self.finished = time.monotonic()
+                self.cond.notify_all()
+
+    def joinable(self):
+        if self.base > 0 or self.closed:
+            return False
+        return self.finished is None or (self.error is None and time.monotonic() - self.finished <= self.ttl)
+
+    def join(self):
+        """A reader from the start of the pass, None if it can't be replayed"""
+        with self.cond:
+            if not self.joinable():
+                return None
+            reader = SharedScanReader(self)
+            self.readers.add(reader)
+            return reader
+
+class SharedScanReader:
+    def __init__(self, scan):
+        self.scan = scan
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        scan = self.scan
+        with scan.cond:
+            scan.cond.wait_for(lambda: self.pos - scan.base < len(scan.items) or scan.finished is not None)
+            if self.pos - scan.base < len(scan.items):
+                item = scan.items[self.pos - scan.base]
+                self.pos += 1
+                if len(scan.items) >= scan.max_items:
+                    scan.cond.notify_all()
+                return item
+            if scan.error is not None:
+                raise scan.error
+            raise StopIteration
+
+def parse_instant(s):
+    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+
+def format_instant(t):
+    return t.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def bundle_next(data):
+    """URL of the next page of a Bundle, None on the last page"""
+    nextURL = None
+    for l in data.get("link", []):
+        if l.get("relation", "") == "next":
+            nextURL = l.get("url", None)
+    return nextURL
+
+def add_query(url, query):
+    return url + ("&" if "?" in url else "?") + query
+
+def drop_query(url, names):
+    """Remove the query parameters in `names` from a URL"""
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k not in names]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query, safe=":,")))
+
+class BundleParser:
+    """Incremental parser for searchset Bundles. Text is fed in as it arrives
+    and complete `entry` items are collected in `entries` as soon as they
+    have been read, along with the `next` link URL, without holding the
+    whole Bundle in memory"""
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.state = "start"
+        self.key = None
+        self.entries = []
+        self.next = None
+
+    def _skip(self, chars=" \t\r\n"):
+        while self.pos < len(self.buf) and self.buf[self.pos] in chars:
+            self.pos += 1
+        return self.pos < len(self.buf)
+
+    def _decode(self, final):
+        """Decode the value at the current position, None if it isn't complete yet"""
+        try:
+            value, end = self.decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # a number at the end of the buffer may still be missing digits
+        if end == len(self.buf) and not final:
+            return None
+        self.pos = end
+        return (value,)
+
+    def feed(self, text, final=False):
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        while self.state != "done":
+            if self.state == "start":
+                if not self._skip():
+                    break
+                if self.buf[self.pos] != "{":
+                    raise ValueError("Bundle is not a JSON object")
+                self.pos += 1
+                self.state = "key"
+            elif self.state == "key":
+                if not self._skip(" \t\r\n,"):
+                    break
+                if self.buf[self.pos] == "}":
+                    self.pos += 1
+                    self.state = "done"
+                    break
+                v = self._decode(final)
+                if v is None:
+                    break
+                self.key = v[0]
+                self.state = "colon"
+            elif self.state == "colon":
+                if not self._skip():
+                    break
+                if self.buf[self.pos] != ":":
+                    raise ValueError("Malformed Bundle")
+                self.pos += 1
+                self.state = "entries" if self.key == "entry" else "value"
+            elif self.state == "value":
+                if not self._skip():
+                    break
+                v = self._decode(final)
+                if v is None:
+                    break
+                if self.key == "link":
+                    for l in v[0]:
+                        if l.get("relation", "") == "next":
+                            self.next = l.get("url", None)
+                self.state = "key"
+            elif self.state == "entries":
+                if not self._skip():
+                    break
+                if self.buf[self.pos] != "[":
+                    raise ValueError("Bundle entry is not a list")
+                self.pos += 1
+                self.state = "entry"
+            elif self.state == "entry":
+                if not self._skip(" \t\r\n,"):
+                    break
+                if self.buf[self.pos] == "]":
+                    self.pos += 1
+                    self.state = "key"
+                    continue
+                v = self._decode(final)
+                if v is None:
+                    break
+                self.entries.append(v[0])
+
+class ResourceCache:
+    """Bounded LRU cache of resources keyed by (resourceType, id). Entries
+    past their TTL are kept so they can be revalidated with their ETag"""
+    Entry = collections.namedtuple("Entry", ["resource", "size", "expires", "etag"])
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def lookup(self, res, id):
+        """Returns (resource, etag, fresh), or None if the resource isn't cached"""
+        with self.lock:
+            e = self.entries.get((res, id))
+            if e is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((res, id))
+            fresh = e.expires > time.monotonic()
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return e.resource, e.etag, fresh
+
+    def put(self, res, id, resource, size, ttl, etag=None):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((res, id), None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[(res, id)] = self.Entry(resource, size, time.monotonic() + ttl, etag)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, e = self.entries.popitem(last=False)
+                self.size -= e.size
+                self.evictions += 1
+
+    def renew(self, res, id, ttl):
+        """Extend the life of an entry that was revalidated upstream"""
+        with self.lock:
+            e = self.entries.get((res, id))
+            if e is not None:
+                self.entries[(res, id)] = e._replace(expires=time.monotonic() + ttl)
+                self.revalidated += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size
+            }
+
+def resource_etag(resource, etag=None):
+    """ETag for a resource, built from meta.versionId when the server didn't send one"""
+    if etag is None and "versionId" in resource.get("meta", {}):
+        etag = 'W/"%s"' % (resource['meta']['versionId'])
+    return etag
+
+# What the CapabilityStatement says about each resource type. Built whole by
+# FHIRClient._index_metadata and swapped in with one assignment, so a
+# lookup never sees parts of two versions
+MetadataIndex = collections.namedtuple("MetadataIndex",
+    ["resources", "search_fields", "search_index", "export_types"])
+
 class FHIRClient:
     def __init__(self, config):
+        self.config = config
         self.base_url = config["FHIR_API"]
+        # every session made, they are kept for the life of the client so
+        # connection counts are cumulative
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+        self.requests_sent = 0
+        # by default one session, and its connection pools, is shared by all
+        # threads. FHIR_SESSION_PER_THREAD keeps a pool of sessions instead,
+        # each used by one request at a time. The threads that fetch pages
+        # are often short lived, so sessions aren't tied to threads
+        self.per_thread = config.get("FHIR_SESSION_PER_THREAD", False)
+        self.idle_sessions = []
+        if not self.per_thread:
+            self.session = self._new_session()
+        # bulk export files can be on other hosts, e.g. presigned storage
+        # URLs, which are fetched without the server's credentials
+        self.file_session = self._new_session(credentials=False)
+        self.mirror = None
+        # optionally bound the number of requests in flight against the
+        # upstream server, by default every worker thread can have one
+        limit = config.get("FHIR_MAX_CONCURRENCY")
+        self.inflight = threading.BoundedSemaphore(limit) if limit else contextlib.nullcontext()
+        # pages of a Bundle search fetched ahead of the consumer
+        self.prefetch_pages = config.get("PREFETCH_PAGES", 1)
+        self.prefetch_bytes = config.get("PREFETCH_MAX_BYTES", 64 * 1024 * 1024)
+        # parse Bundle pages incrementally as they download, rather than
+        # loading each page in full before handing out its entries
+        self.stream_json = config.get("STREAM_JSON", False)
+        self.stream_chunk = config.get("STREAM_CHUNK", 100)
+        # resources read by id are cached when CACHE_MAX_BYTES is set
+        self.cache = None
+        if config.get("CACHE_MAX_BYTES", 0) > 0:
+            self.cache = ResourceCache(config["CACHE_MAX_BYTES"])
+        self.update_metadata()
+        if config.get("METADATA_REFRESH", 0) > 0:
+            self.start_metadata_refresh(config["METADATA_REFRESH"])
+        # selected collections are read from a local copy once it is loaded
+        if "MIRROR" in config:
+            self.mirror = FHIRMirror(config["MIRROR"])
+            self.mirror.start_sync(self, config.get("MIRROR_COLLECTIONS", []),
+                config.get("MIRROR_REFRESH", 3600), config.get("MIRROR_REBUILD"))
+
+    def _new_session(self, credentials=True):
+        config = self.config
         session = requests.session()
-        if 'FHIR_COOKIE' not in config:
+        if credentials and 'FHIR_COOKIE' not in config:
             session.auth = HTTPBasicAuth(config["FHIR_USER"], config["FHIR_PW"])
         session.headers = {
             "Content-Type": "application/fhir+json",
-            "accept": "application/fhir+json;charset=utf-8"
+            "accept": "application/fhir+json;charset=utf-8",
+            "Accept-Encoding": ACCEPT_ENCODING
         }
-        if 'FHIR_COOKIE' in config:
+        if credentials and 'FHIR_COOKIE' in config:
             session.headers["cookie"] = f"AWSELBAuthSessionCookie-0=%s" % (config["FHIR_COOKIE"])
+        retries = Retry(total=config.get("FHIR_RETRIES", 3), backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504])
+        size = config.get("FHIR_POOL_SIZE", config.get("FHIR_MAX_CONCURRENCY") or 10)
+        session.mount("http://", HTTPAdapter(pool_maxsize=size, max_retries=retries))
+        session.mount("https://", HTTPAdapter(pool_maxsize=size, max_retries=retries))
+        # hosts can be given their own pool size, e.g. for bulk export file servers
+        for host, hostSize in config.get("FHIR_HOST_POOL_SIZE", {}).items():
+            adapter = HTTPAdapter(pool_maxsize=hostSize, max_retries=retries)
+            session.mount("http://%s/" % (host), adapter)
+            session.mount("https://%s/" % (host), adapter)
+        with self.sessions_lock:
+            self.sessions.append(session)
+        return session
 
-        class Config:
-            """Store config in class."""
+    def _checkout(self):
+        """A session for one request, from the pool with FHIR_SESSION_PER_THREAD"""
+        if not self.per_thread:
+            return self.session
+        with self.sessions_lock:
+            if self.idle_sessions:
+                return self.idle_sessions.pop()
+        return self._new_session()
 
-        self.session = session
-        self.update_metadata()
+    def _checkin(self, session):
+        if self.per_thread:
+            with self.sessions_lock:
+                self.idle_sessions.append(session)
+
+    def connection_stats(self):
+        """Counts of requests sent and new connections opened since the
+        client started. Requests that didn't need a new connection reused one"""
+        connections = 0
+        with self.sessions_lock:
+            sessions = list(self.sessions)
+            requests = self.requests_sent
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+        return {
+            "sessions": len(sessions),
+            "requests": requests,
+            "connections": connections,
+            "reused": requests - connections
+        }
+
+    def _mirrored(self, res):
+        return self.mirror is not None and self.mirror.has(res)
+
+    def _get(self, url, headers=None, stream=False, session=None):
+        with self.inflight:
+            metrics.FHIR_IN_FLIGHT.inc()
+            start = time.monotonic()
+            pooled = session is None
+            if pooled:
+                session = self._checkout()
+            try:
+                resp = session.get(url, headers=headers, stream=stream)
+            finally:
+                metrics.FHIR_IN_FLIGHT.dec()
+                if pooled:
+                    self._checkin(session)
+                with self.sessions_lock:
+                    self.requests_sent += 1
+            metrics.FHIR_LATENCY.observe(time.monotonic() - start)
+            metrics.FHIR_STATUS.inc(1, resp.status_code)
+            return resp
 
     def update_metadata(self):
-        resp = self.session.get(config["FHIR_API"] + "metadata")
-        self.rest_data = resp.json().get("rest", [])
+        resp = self._get(self.base_url + "metadata")
+        data = resp.json()
+        definitions = None
+        if self._wants_definitions(data):
+            try:
+                definitions = self.get_search_parameters()
+            except Exception as e:
+                print("Reading SearchParameter definitions failed: %s" % (e))
+        self._index_metadata(data, definitions)
 
-    def get_resources(self):
-        for r in self.rest_data:
+    def _wants_definitions(self, data):
+        """SearchParameter definitions are read when the server lists them,
+        unless SEARCH_PARAMETER_DEFINITIONS is turned off"""
+        return self.config.get("SEARCH_PARAMETER_DEFINITIONS", True) and any(
+            res.get("type") == "SearchParameter" for r in data.get("rest", []) for res in r.get("resource", []))
+
+    def get_search_parameters(self):
+        """The SearchParameter resources of the server, for the FHIRPath
+        expression of each parameter"""
+        params = [("_count", 500), ("_elements", "url,code,base,type,expression")]
+        return list(self._paginate(self.search_url("SearchParameter", params), prefetch=False))
+
+    def _index_metadata(self, data, definitions=None):
+        """Index the CapabilityStatement by resource type, with the search
+        fields of each type worked out up front, so collection info is
+        answered from memory. Element paths are mapped to the search
+        parameters covering them, using the SearchParameter `definitions` if
+        given. Lookups see either the old or the new index"""
+        rest_data = data.get("rest", [])
+        resources = {}
+        search_fields = {}
+        # collections that can be read with the Bulk Data $export operation,
+        # None if it is supported at the system level for every type
+        export_types = set()
+        for r in rest_data:
+            for op in r.get("operation", []):
+                if op.get("name") == "export":
+                    export_types = None
             for res in r.get("resource", []):
-                yield res['type']
+                if res['type'] in resources:
+                    continue
+                resources[res['type']] = res
+                search_fields[res['type']] = ["$." + p['name'] for p in res.get("searchParam", [])]
+                for op in res.get("operation", []):
+                    if op.get("name") == "export" and export_types is not None:
+                        export_types.add(res['type'])
+        self.metadata = MetadataIndex(resources, search_fields,
+            SearchPathIndex(resources, definitions), export_types)
+
+    def start_metadata_refresh(self, interval):
+        """Re-read the CapabilityStatement every `interval` seconds on a
+        background thread, keeping the current copy if that fails"""
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.update_metadata()
+                except Exception as e:
+                    print("Metadata refresh failed: %s" % (e))
+        threading.Thread(target=run, daemon=True).start()
+        return stop
+
+    def supports_export(self, res):
+        export_types = self.metadata.export_types
+        return export_types is None or res in export_types
+
+    def collection_option(self, name, key, default=None):
+        """Look up a setting for a collection, per collection values are set
+        under COLLECTIONS in the config and fall back to the top level key"""
+        c = self.config.get("COLLECTIONS", {}).get(name, {})
+        return c.get(key, self.config.get(key, default))
+
+    def get_resources(self):
+        return list(self.metadata.resources)
 
     def get_resource_info(self, name):
-        for r in self.rest_data:
-            for res in r.get("resource", []):
-                if res['type'] == name:
-                    return res
+        return self.metadata.resources.get(name)
 
-    def list_resource(self, name):
-        resp = self.session.get(config["FHIR_API"] + name)
-        data = resp.json()
-        while data is not None:
-            for r in data.get("entry", []):
-                yield r['resource']['id'], r['resource']
-            nextURL = None
-            for l in data.get("link", []):
-                if l.get("relation", "") == "next":
-                    nextURL = l.get("url", None)
-            if nextURL is not None:
-                resp = self.session.get(nextURL)
-                data = resp.json()
-            else:
-                data = None
+    def get_search_fields(self, name):
+        return self.metadata.search_fields.get(name, [])
 
-    def get_entry(self, res, id):
-        resp = self.session.get(config["FHIR_API"] + res + "/" + id)
-        return resp.json()
+    def search_param(self, res, field):
+        """Search parameter covering an element path, `code.coding.code` ->
+        `code`. None if no parameter of the type reads that element"""
+        return self.metadata.search_index.resolve(res, field)
 
-    def scan_resource(self, res, field, value):
-        url = config["FHIR_API"] + res + "?%s=%s" % (field, value)
-        resp = self.session.get(url)
-        data = resp.json()
-        while data is not None:
-            for r in data.get("entry", []):
-                yield r['resource']['id'], r['resource']
-            nextURL = None
-            for l in data.get("link", []):
-                if l.get("relation", "") == "next":
-                    nextURL = l.get("url", None)
-            if nextURL is not None:
-                resp = self.session.get(nextURL)
-                data = resp.json()
-            else:
-                data = None
+    def param_paths(self, res, param):
+        """Element paths read by a search parameter"""
+        return self.metadata.search_index.paths(res, param)
 
-    def scan_nonempty_field(self, res, field):
-        url = config["FHIR_API"] + res + "?%s:missing=false&_elements=%s" % (field, field)
-        resp = self.session.get(url)
-        data = resp.json()
-        while data is not None:
-            for r in data.get("entry", []):
-                if field in r['resource']:
-                    yield r['resource']['id'], r['resource'][field]
-            nextURL = None
-            for l in data.get("link", []):
-                if l.get("relation", "") == "next":
-                    nextURL = l.get("url", None)
-            if nextURL is not None:
-                resp = self.session.get(nextURL)
-                data = resp.json()
+    def param_type(self, res, param):
+        """Type of a search parameter, as declared in the CapabilityStatement"""
+        return self.metadata.search_index.type(res, param)
+
+    def search_url(self, res, params):
+        """Build a search URL from a list of (key, value) query parameters"""
+        if len(params) == 0:
+            return self.base_url + res
+        return self.base_url + res + "?" + urllib.parse.urlencode(params, safe=":,")
+
+    def page_params(self, res, elements=None, options=NO_OPTIONS):
+        """Paging and projection parameters for a search on a collection,
+        with any extra search parameters of the call"""
+        params = list(options.params)
+        count = self.collection_option(res, "PAGE_SIZE")
+        if options.limit is not None:
+            count = options.limit if count is None else min(count, options.limit)
+        if count is not None:
+            params.append(("_count", count))
+        if elements is not None:
+            params.append(("_elements", ",".join(elements)))
+        return params
+
+    def list_resource(self, name, elements=None, options=NO_OPTIONS):
+        if self._mirrored(name) and not options.params:
+            return self.mirror.list(name)
+        return self.scan_collection(name, elements, options)
+
+    def scan_collection(self, name, elements=None, options=NO_OPTIONS):
+        """Page through a whole collection on the FHIR server, using $export
+        when BULK_EXPORT is enabled and the server supports it"""
+        bulk = not options.params and options.limit is None
+        if bulk and self.collection_option(name, "BULK_EXPORT", False) and self.supports_export(name):
+            status = self._start_export(name, elements)
+            if status is not None:
+                for r in self._export_results(name, status, options.cancel):
+                    yield r['id'], r
+                return
+        url = self.search_url(name, self.page_params(name, elements, options))
+        for r in self._scan(name, url, options):
+            yield r['id'], r
+
+    def _start_export(self, res, elements=None):
+        """Kick off a Bulk Data export of one collection, returns the status
+        URL to poll, or None if the server refused the export"""
+        params = [("_type", res)]
+        if elements is not None:
+            params.append(("_elements", ",".join(elements)))
+        headers = {"Accept": "application/fhir+json", "Prefer": "respond-async"}
+        resp = self._get(self.search_url("$export", params), headers=headers)
+        if resp.status_code != 202 or "Content-Location" not in resp.headers:
+            print("Export of %s not started (%s), falling back to search" % (res, resp.status_code))
+            return None
+        return resp.headers["Content-Location"]
+
+    def _export_results(self, res, status, cancel=None):
+        """Poll an export until it completes, then stream the resources from
+        its NDJSON output files. Stops early once `cancel` is set"""
+        poll = self.config.get("BULK_EXPORT_POLL", 5)
+        cancel = cancel or threading.Event()
+        while True:
+            resp = self._get(status, headers={"Accept": "application/json"})
+            if resp.status_code != 202:
+                break
+            retry = resp.headers.get("Retry-After", "")
+            if cancel.wait(int(retry) if retry.isdigit() else poll):
+                return
+        if resp.status_code != 200:
+            raise Exception("Export of %s failed: %s %s" % (res, resp.status_code, resp.text))
+        manifest = resp.json()
+        # the server's credentials only go with the files when the manifest
+        # says they are needed
+        session = None if manifest.get("requiresAccessToken") else self.file_session
+        for out in manifest.get("output", []):
+            if out.get("type", res) != res:
+                continue
+            data = self._get(out['url'], headers={"Accept": "application/fhir+ndjson"},
+                stream=True, session=session)
+            try:
+                data.raise_for_status()
+                for line in data.iter_lines():
+                    if cancel.is_set():
+                        return
+                    if line:
+                        yield json.loads(line)
+            finally:
+                data.close()
+
+    def _cached(self, res, ids):
+        """Split ids into the resources served from the cache and the ids
+        left to fetch. Expired entries with an ETag are revalidated together
+        with one `_id` search returning only `meta`, and those whose
+        versionId hasn't changed are renewed instead of downloaded again"""
+        ids = list(ids)
+        if self.cache is None:
+            return {}, ids
+        out = {}
+        missing = []
+        stale = {}
+        for i in ids:
+            cached = self.cache.lookup(res, i)
+            if cached is not None and cached[2]:
+                out[i] = cached[0]
+            elif cached is not None and cached[1] is not None:
+                stale[i] = cached
             else:
-                data = None
+                missing.append(i)
+        if stale:
+            ttl = self.collection_option(res, "CACHE_TTL", 300)
+            params = [("_id", ",".join(stale)), ("_count", len(stale)), ("_elements", "id,meta")]
+            for r in self._paginate(self.search_url(res, params), prefetch=False):
+                i = r.get('id')
+                if i in stale and r.get("resourceType", res) == res and resource_etag(r) == stale[i][1]:
+                    self.cache.renew(res, i, ttl)
+                    out[i] = stale.pop(i)[0]
+            missing.extend(stale)
+        return out, missing
+
+    def get_entries(self, res, ids):
+        """Fetch a group of resources with a single `_id` search.
+        Returns a dict of id to resource, ids that were not found are missing"""
+        if self._mirrored(res):
+            return self.mirror.get(res, ids)
+        out, ids = self._cached(res, ids)
+        if len(ids) == 0:
+            return out
+        ttl = self.collection_option(res, "CACHE_TTL", 300)
+        url = self.search_url(res, [("_id", ",".join(ids)), ("_count", len(ids))])
+        for page in self._pages(url):
+            for e in page.entries:
+                r = e['resource']
+                if r.get("resourceType", res) == res:
+                    out[r['id']] = r
+                    if self.cache is not None:
+                        self.cache.put(res, r['id'], r, page.size // len(page.entries), ttl, resource_etag(r))
+        return out
+
+    def get_elements(self, res, ids, elements):
+        """Fetch only `elements` of a group of resources with one `_id`
+        search. Full copies held in the mirror or the cache are used when
+        available, projected resources are not cached"""
+        if self._mirrored(res):
+            return self.mirror.get(res, ids)
+        out, ids = self._cached(res, ids)
+        if len(ids) == 0:
+            return out
+        params = [("_id", ",".join(ids)), ("_count", len(ids)), ("_elements", ",".join(elements))]
+        for r in self._paginate(self.search_url(res, params), prefetch=False):
+            if r.get("resourceType", res) == res:
+                out[r['id']] = r
+        return out
+
+    def search_joined(self, res, params, options=NO_OPTIONS):
+        """Search with `_include` or `_revinclude` parameters, so the matched
+        resources and the ones they join to come back in the same Bundle.
+        Every resource is put in the cache, so following reads of either
+        endpoint are served locally. Yields (resource, search mode)"""
+        url = self.search_url(res, params + self.page_params(res, options=options))
+        for page in self._pages(url, options.cancel):
+            for e in page.entries:
+                r = e['resource']
+                if self.cache is not None and 'id' in r:
+                    rt = r.get("resourceType", res)
+                    self.cache.put(rt, r['id'], r, page.size // len(page.entries),
+                        self.collection_option(rt, "CACHE_TTL", 300), resource_etag(r))
+                yield r, e.get("search", {}).get("mode")
+
+    def searches_locally(self, res, field):
+        """True if searches on the field are answered by the mirror"""
+        return self.mirror is not None and self.mirror.can_search(res, field)
+
+    def scan_resource(self, res, field, value, elements=None, options=NO_OPTIONS):
+        """Search on one field, `value` may be a comma separated list of values"""
+        if self.searches_locally(res, field) and not options.params:
+            # the only modifier left is a reference type, callers filter
+            # typed references themselves
+            yield from self.mirror.search(res, field.split(":")[0], value)
+            return
+        url = self.search_url(res, [(field, value)] + self.page_params(res, elements, options))
+        for r in self._paginate(url, options.limit is None, options.cancel):
+            yield r['id'], r
+
+    def scan_nonempty_field(self, res, field, options=NO_OPTIONS):
+        if self._mirrored(res) and not options.params:
+            for i, r in self.mirror.list(res):
+                if field in r:
+                    yield i, r[field]
+            return
+        params = [("%s:missing" % (field), "false")] + self.page_params(res, [field], options)
+        for r in self._scan(res, self.search_url(res, params), options):
+            if field in r:
+                yield r['id'], r[field]
+
+    def scan_updated(self, res, since, elements=None):
+        """Page through the resources of a collection updated after `since`"""
+        params = [("_lastUpdated", "gt" + format_instant(since))] + self.page_params(res, elements)
+        for r in self._paginate(self.search_url(res, params)):
+            yield r['id'], r
+
+    def _scan(self, name, url, options=NO_OPTIONS):
+        """Page through a search over a whole collection. When SCAN_PARTITIONS
+        is set the search is split into partitions that are fetched
+        concurrently and merged. Searches with their own parameters or a
+        limit are read in order, one page at a time. With a cursor, the
+        pages read are checkpointed, and a resumed cursor continues each
+        partition from its checkpoint"""
+        cursor = options.cursor
+        if cursor is not None and cursor.resuming():
+            specs = cursor.remaining()
+        else:
+            specs = dict(enumerate(self._partitions(name, url, options)))
+            if cursor is not None:
+                cursor.start(specs)
+        prefetch = not options.params and options.limit is None
+        # PREFETCH_MAX_BYTES caps the whole scan, not each partition
+        budget = PrefetchBudget(self.prefetch_bytes)
+        parts = [self._paginate(u, prefetch, options.cancel, limit, part if cursor is not None else None, budget)
+            for part, (u, limit) in specs.items()]
+        if len(parts) == 1:
+            items = parts[0]
+        else:
+            items = merge_iterators(parts)
+        if cursor is not None:
+            return cursor.follow(items)
+        return items
+
+    def _partitions(self, name, url, options=NO_OPTIONS):
+        """The (url, max resources) of each partition of a scan"""
+        count = self.collection_option(name, "SCAN_PARTITIONS", 1)
+        if options.params or options.limit is not None or count <= 1:
+            return [(url, None)]
+        mode = self.collection_option(name, "SCAN_PARTITION_MODE", "lastUpdated")
+        if mode == "offset":
+            return self._offset_partitions(url, count)
+        elif mode == "lastUpdated":
+            return self._last_updated_partitions(url, count)
+        else:
+            raise ValueError("Unknown SCAN_PARTITION_MODE: %s" % (mode))
+
+    def _last_updated_partitions(self, url, count):
+        """Split a search into `count` equal `_lastUpdated` time ranges. The
+        bounds are probed with the full resources, as `_elements` may leave
+        out `meta`. Servers that don't send `meta.lastUpdated` get a single
+        partition"""
+        bounds = []
+        probe = drop_query(url, ("_elements", "_count", "_sort"))
+        for sort in ["_lastUpdated", "-_lastUpdated"]:
+            data = self._get(add_query(probe, "_sort=%s&_count=1" % (sort))).json()
+            entries = data.get("entry", [])
+            if len(entries) == 0:
+                return [(url, None)]
+            lastUpdated = entries[0].get('resource', {}).get('meta', {}).get('lastUpdated')
+            if lastUpdated is None:
+                return [(url, None)]
+            bounds.append(parse_instant(lastUpdated))
+        first, last = bounds
+        if first >= last:
+            return [(url, None)]
+        step = (last - first) / count
+        cuts = [format_instant(first + step * i) for i in range(1, count)]
+        parts = []
+        for i in range(count):
+            query = []
+            if i > 0:
+                query.append("_lastUpdated=ge%s" % (cuts[i-1]))
+            if i < count - 1:
+                query.append("_lastUpdated=lt%s" % (cuts[i]))
+            parts.append((add_query(url, "&".join(query)), None))
+        return parts
+
+    def _offset_partitions(self, url, count):
+        """Split a search into `count` `_offset` windows, for servers that
+        support `_offset` paging. Every window is sorted on `_id`, as the
+        windows are separate searches and an unsorted order may differ
+        between them"""
+        probe = drop_query(url, ("_elements", "_count", "_sort"))
+        total = self._get(add_query(probe, "_summary=count")).json().get("total", 0)
+        if total == 0:
+            return [(url, None)]
+        size = -(-total // count)
+        url = add_query(drop_query(url, ("_sort",)), "_sort=_id")
+        parts = []
+        for start in range(0, total, size):
+            parts.append((add_query(url, "_offset=%d" % (start)), size))
+        return parts
+
+    def _pages(self, url, cancel=None):
+        """Follow the `next` links of a Bundle search, yielding each page.
+        No more pages are requested once `cancel` is set"""
+        while url is not None:
+            if cancel is not None and cancel.is_set():
+                return
+            if self.stream_json:
+                url = yield from self._stream_page(url)
+                continue
+            resp = self._get(url)
+            data = resp.json()
+            metrics.FHIR_PAGES.inc()
+            metrics.FHIR_BYTES.inc(len(resp.content))
+            yield Page(url, data.get("entry", []), len(resp.content))
+            url = bundle_next(data)
+
+    def _stream_page(self, url):
+        """Parse a Bundle page as it downloads, yielding its entries in
+        chunks of STREAM_CHUNK. Returns the URL of the next page"""
+        resp = self._get(url, stream=True)
+        parser = BundleParser()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        size = 0
+        metrics.FHIR_PAGES.inc()
+        for data in resp.iter_content(64 * 1024):
+            metrics.FHIR_BYTES.inc(len(data))
+            size += len(data)
+            parser.feed(decoder.decode(data))
+            if len(parser.entries) >= self.stream_chunk:
+                yield Page(url, parser.entries, size)
+                parser.entries = []
+                size = 0
+        parser.feed(decoder.decode(b"", final=True), final=True)
+        yield Page(url, parser.entries, size)
+        return parser.next
 
+    def _paginate(self, url, prefetch=True, cancel=None, limit=None, part=None, budget=None):
+        """Resources of a search, at most `limit` of them. When `part` is
+        set a ScanMark for the partition comes before each page. Prefetched
+        pages count against `budget`, or a budget of their own"""
+        pages = self._pages(url, cancel)
+        if prefetch and self.prefetch_pages > 0:
+            pages = Prefetcher(pages, self.prefetch_pages, budget or PrefetchBudget(self.prefetch_bytes))
+        for page in pages:
+            if part is not None:
+                yield ScanMark(part, page.url, limit)
+            entries = page.entries
+            if limit is not None:
+                entries = entries[:limit]
+                limit -= len(entries)
+            for r in entries:
+                yield r['resource']
+            if limit == 0:
+                break
+        # a scan stopped by `cancel` hasn't finished the partition
+        if part is not None and not (cancel is not None and cancel.is_set()):
+            yield ScanMark(part, None, 0)
+
+
+
+EdgeTable = collections.namedtuple("EdgeTable", ["src", "edge", "dst", "typed"])
+
+class UnknownEdgeTable(KeyError):
+    """An edge collection name that isn't one of the schema's edge tables"""
 
 class Schema:
+    """Edges of the graph, as `edges: {Src: {field: Dst}}`. A field holding
+    references to several types maps to a list, `{field: [Dst1, Dst2]}`,
+    and gets one edge table per destination type"""
     def __init__(self, config):
         self.config = config
 
     def get_edges(self):
+        for t in self.get_edge_tables():
+            if t.typed:
+                yield "%s:%s:%s:edges" % (t.src, t.edge, t.dst)
+            else:
+                yield "%s:%s:edges" % (t.src, t.edge)
+
+    def get_edge_fields(self):
         edges = self.config.get("edges", {})
         for sub in edges:
             for pred in edges[sub]:
-                yield "%s:%s:edges" % (sub, pred)
+                yield sub, pred
+
+    def get_edge_tables(self):
+        for sub, pred in self.get_edge_fields():
+            dst = self.get_dst(sub, pred)
+            if isinstance(dst, list):
+                for d in dst:
+                    yield EdgeTable(sub, pred, d, True)
+            else:
+                yield EdgeTable(sub, pred, dst, False)
 
     def get_dst(self, src, edge):
         edges = self.config.get("edges", {})
@@ -129,20 +1067,279 @@ class Schema:
             if edge in edges[src]:
                 return edges[src][edge]
 
+    def edge_table(self, name):
+        """Parse an edge collection name, `Src:edge:edges`, or
+        `Src:edge:Dst:edges` for one destination of a polymorphic edge.
+        Raises UnknownEdgeTable if the schema has no such table, this
+        includes the untyped name of a polymorphic edge"""
+        parts = name.split(":")
+        if len(parts) == 4:
+            t = EdgeTable(parts[0], parts[1], parts[2], True)
+        elif len(parts) == 3:
+            t = EdgeTable(parts[0], parts[1], self.get_dst(parts[0], parts[1]), False)
+        else:
+            raise UnknownEdgeTable(name)
+        if t not in self.get_edge_tables():
+            raise UnknownEdgeTable(name)
+        return t
+
 def edgeID(src,edge,dst,src_id,dst_id):
     return "%s/%s:%s:%s/%s" % (src, src_id, edge, dst, dst_id)
 
+def edgeRow(src,edge,dst,src_id,dst_id):
+    return encode_edge_row(edgeID(src,edge,dst,src_id,dst_id), src, src_id, dst, dst_id)
+
+def parse_edge_id(table, id):
+    """(src id, dst type, dst id) of an edge ID, None if it is malformed or
+    not an edge of `table`"""
+    parts = id.split(":")
+    if len(parts) != 3:
+        return None
+    srcRes, _, srcId = parts[0].partition("/")
+    dstRes, _, dstId = parts[2].partition("/")
+    if srcRes != table.src or parts[1] != table.edge or not srcId or not dstId:
+        return None
+    if table.typed and dstRes != table.dst:
+        return None
+    return srcId, dstRes, dstId
+
 def force_list(x):
     if isinstance(x, list):
         return x
     else:
         return [x]
 
+def edge_refs(table, field):
+    """(reference, dst type, dst id) of the references in an edge field,
+    tables of a polymorphic edge only keep references to their own type"""
+    for j in force_list(field):
+        if 'reference' not in j:
+            continue
+        dstRes, dstId = j['reference'].split("/")[:2]
+        if table.typed and dstRes != table.dst:
+            continue
+        yield j['reference'], dstRes, dstId
+
+def batch_requests(request_iterator, size, window):
+    """Group a stream of RowRequests into per collection batches.
+    A batch is emitted once it holds `size` requests, or `window` seconds
+    after its first request arrived, whichever comes first.
+    Yields (collection, [requests]) tuples"""
+    incoming = queue.Queue()
+    def read():
+        try:
+            for req in request_iterator:
+                incoming.put(req)
+        finally:
+            incoming.put(None)
+    threading.Thread(target=read, daemon=True).start()
+
+    pending = {}
+    deadlines = {}
+    while True:
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines.values()) - time.monotonic())
+        try:
+            req = incoming.get(timeout=timeout)
+        except queue.Empty:
+            now = time.monotonic()
+            for c in [c for c, t in deadlines.items() if t <= now]:
+                del deadlines[c]
+                yield c, pending.pop(c)
+            continue
+        if req is None:
+            for c in list(pending):
+                yield c, pending.pop(c)
+            return
+        batch = pending.setdefault(req.collection, [])
+        if not batch:
+            deadlines[req.collection] = time.monotonic() + window
+        batch.append(req)
+        if len(batch) >= size:
+            del deadlines[req.collection]
+            yield req.collection, pending.pop(req.collection)
+
+def unordered_map(func, items, executor, limit):
+    """Call func(*item) for each item on the executor, with at most `limit`
+    calls in flight. Results are yielded in completion order"""
+    done = queue.Queue()
+    slots = threading.BoundedSemaphore(limit)
+    def finished(f):
+        slots.release()
+        done.put(f)
+    def submit():
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                executor.submit(func, *item).add_done_callback(finished)
+                count += 1
+        finally:
+            done.put(count)
+    threading.Thread(target=submit, daemon=True).start()
+
+    total = None
+    received = 0
+    while total is None or received < total:
+        f = done.get()
+        if isinstance(f, int):
+            total = f
+        else:
+            received += 1
+            yield f.result()
+
+# search parameters the server sets itself, which can't come from fhir-search
+RESERVED_PARAMS = set(["_count", "_elements", "_summary", "_include", "_revinclude"])
+
+def limit_rows(rows, options):
+    """Stop a stream at the row limit of the call, or as soon as the call
+    has ended"""
+    if options.limit is not None:
+        rows = itertools.islice(rows, options.limit)
+    for o in rows:
+        if options.cancel is not None and options.cancel.is_set():
+            return
+        yield o
+
+def matched_values(resource, paths, values):
+    """Which of the searched `values` a resource matched on a search
+    parameter, read from the elements at `paths`, or failing that from any
+    reference, coding or identifier of the resource"""
+    out = set()
+    for path in paths:
+        out.update(search_values(path_values(resource, path)))
+    out &= values
+    if not out:
+        out = set(search_values(list(resource.values()))) & values
+    return out
+
+class FieldCoalescer:
+    """Merges concurrent GetRowsByField calls on the same collection and
+    field into one search with comma separated values. A call waits up to
+    `window` seconds for others to join it, and a group is sent early once
+    it holds `max_values` values. `lookup(collection, field, values, match=...)`
+    yields (row, matched values) pairs, each row goes back to the callers
+    that asked for one of its values. The matched values are only needed,
+    and only worked out, when `match` is set"""
+
+    def __init__(self, lookup, window, max_values, executor):
+        self.lookup = lookup
+        self.window = window
+        self.max_values = max_values
+        self.executor = executor
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, collection, field, values):
+        """Rows for one caller, once its group has been resolved"""
+        key = (collection, field)
+        future = futures.Future()
+        with self.lock:
+            group = self.pending.get(key)
+            if group is None:
+                group = self.pending[key] = []
+                timer = threading.Timer(self.window, self._flush, (key, group))
+                timer.daemon = True
+                timer.start()
+            group.append((set(values), future))
+            full = sum(len(v) for v, _ in group) >= self.max_values
+            if full:
+                del self.pending[key]
+        if full:
+            self.executor.submit(self._send, key, group)
+        return future.result()
+
+    def _flush(self, key, group):
+        with self.lock:
+            if self.pending.get(key) is not group:
+                return # already sent when it filled up
+            del self.pending[key]
+        self._send(key, group)
+
+    def _send(self, key, group):
+        collection, field = key
+        try:
+            if len(group) == 1:
+                values, future = group[0]
+                future.set_result([o for o, _ in self.lookup(collection, field, list(values), match=False)])
+                return
+            values = list(dict.fromkeys(v for vs, _ in group for v in vs))
+            found = list(self.lookup(collection, field, values, match=True))
+            if any(len(m) == 0 for _, m in found):
+                # the results can't be told apart, look each caller up on its own
+                for vs, future in group:
+                    future.set_result([o for o, _ in self.lookup(collection, field, list(vs), match=False)])
+                return
+            for vs, future in group:
+                future.set_result([o for o, m in found if m & vs])
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
 class FHIRServicer(gripper_pb2_grpc.GRIPSourceServicer):
-    def __init__(self, fhir, schema):
+    def __init__(self, fhir, schema, config={}):
         self.fhir = fhir
         self.schema = schema
+        # GetRowsByID requests are grouped into micro-batches, each resolved
+        # with a single `_id` search against the FHIR server
+        self.batch_size = config.get("BATCH_SIZE", 100)
+        self.batch_window = config.get("BATCH_WINDOW", 0.005)
+        # number of batches resolved concurrently per GetRowsByID stream,
+        # when > 1 rows are returned in completion order rather than request order
+        self.lookup_concurrency = config.get("ROWS_BY_ID_CONCURRENCY", 1)
+        self.lookup_pool = futures.ThreadPoolExecutor(max_workers=config.get("LOOKUP_WORKERS", 32))
+        # edge tables are served from a local index once it has been built
+        self.edge_index = None
+        if "EDGE_INDEX" in config:
+            self.edge_index = EdgeIndex(config["EDGE_INDEX"])
+            self.edge_index.start_refresh(fhir, schema, config.get("EDGE_INDEX_REFRESH", 3600),
+                config.get("EDGE_INDEX_REBUILD"))
+        # edge lookups by field also fetch the records at the other end of the
+        # edge, with `_include`/`_revinclude`, and keep them in the resource cache
+        self.prefetch_endpoints = config.get("EDGE_PREFETCH_ENDPOINTS", False) and fhir.cache is not None
+        # how edge IDs in GetRowsByID are checked: `fetch` reads the source
+        # records, `verify` only checks the edge exists, in the edge index or
+        # with the edge field of the source records, `trust` builds the row
+        # from the ID alone
+        self.edge_id_mode = config.get("EDGE_ID_MODE", "fetch")
+        if self.edge_id_mode not in ("fetch", "verify", "trust"):
+            raise ValueError("Unknown EDGE_ID_MODE: %s" % (self.edge_id_mode))
+        # scans of the edge tables of one source type share a single pass over
+        # it, reading all of their reference fields at once
+        self.shared_scans = None
+        if config.get("EDGE_SCAN_SHARED", False):
+            self.shared_scans = {}
+            self.shared_lock = threading.Lock()
+            self.shared_buffer = config.get("EDGE_SCAN_BUFFER", 100000)
+            self.shared_ttl = config.get("EDGE_SCAN_TTL", 60)
+        # GetRows and GetIDs checkpoint their scans under a cursor token, so
+        # a broken stream can be resumed
+        self.cursors = None
+        if config.get("SCAN_CURSORS", False):
+            self.cursors = CursorStore(config.get("CURSOR_DIR"), config.get("CURSOR_TTL", 86400),
+                config.get("CURSOR_HISTORY", 50))
+        # concurrent GetRowsByField calls on the same collection and field
+        # are merged into one search, waiting up to FIELD_COALESCE_WINDOW seconds
+        self.coalescer = None
+        if config.get("FIELD_COALESCE_WINDOW", 0) > 0:
+            self.coalescer = FieldCoalescer(self._rows_by_field, config["FIELD_COALESCE_WINDOW"],
+                config.get("FIELD_COALESCE_MAX_VALUES", 50), self.lookup_pool)
+
+    def _joined(self, res, mode, params, srcRes=None, options=NO_OPTIONS):
+        """Source records of an `_include` or `_revinclude` search, the
+        other endpoints are left in the resource cache. Servers that don't
+        mark the search mode of entries are matched on resource type"""
+        srcRes = srcRes or res
+        for r, m in self.fhir.search_joined(res, params, options):
+            if m in (mode, None) and r.get("resourceType") == srcRes:
+                yield r['id'], r
 
+    def _indexed(self, src, edge):
+        return self.edge_index is not None and self.edge_index.is_indexed(src, edge)
+
+    @metrics.instrument_rpc
     def GetCollections(self, request, context):
         for i in self.fhir.get_resources():
             o = gripper_pb2.Collection()
@@ -154,125 +1351,341 @@ class FHIRServicer(gripper_pb2_grpc.GRIPSourceServicer):
             o.name = e
             yield o
 
+    def _edge_table(self, name, context):
+        """Edge table of a collection, aborting the call with NOT_FOUND if
+        the schema has no such table"""
+        try:
+            return self.schema.edge_table(name)
+        except UnknownEdgeTable:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Unknown edge table: %s" % (name))
+
+    @metrics.instrument_rpc
     def GetCollectionInfo(self, request, context):
         if request.name.endswith(":edges"):
-            src, edge, _ = request.name.split(":")
-            dst = self.schema.get_dst(src, edge)
+            t = self._edge_table(request.name, context)
             o = gripper_pb2.CollectionInfo()
-            o.search_fields.extend( ["$." + src, "$." + dst] )
+            o.search_fields.extend( ["$." + t.src, "$." + t.dst] )
             return o
 
-        res = self.fhir.get_resource_info(request.name)
         o = gripper_pb2.CollectionInfo()
-        for param in res['searchParam']:
-            o.search_fields.append("$." + param['name'])
+        o.search_fields.extend(self.fhir.get_search_fields(request.name))
         return o
 
+    def _search_options(self, context):
+        """Search settings sent by the client as invocation metadata:
+        `fhir-limit`, a max number of rows, and `fhir-search`, a query string
+        of extra FHIR search parameters (e.g. `_sort=-date&date=ge2020-01-01`)
+        added to the upstream search"""
+        md = dict(context.invocation_metadata() or ())
+        limit = md.get("fhir-limit")
+        if limit is not None:
+            if not limit.isdigit() or int(limit) == 0:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "fhir-limit must be a positive integer")
+            limit = int(limit)
+        params = urllib.parse.parse_qsl(md.get("fhir-search", ""))
+        for k, _ in params:
+            if k in RESERVED_PARAMS:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "%s can't be set in fhir-search" % (k))
+        # set when the call ends for any reason, including client cancellation
+        cancel = threading.Event()
+        if not context.add_callback(cancel.set):
+            cancel.set()
+        return SearchOptions(params, limit, cancel, None)
+
+    def _cursor(self, method, name, context, options):
+        """Attach a cursor to the options of a GetRows or GetIDs call. The
+        call resumes the cursor given as `fhir-cursor` in the invocation
+        metadata, after the `fhir-cursor-rows` rows received from the call
+        that broke, or starts a new one. Its token is sent back as
+        `fhir-cursor` in the initial metadata"""
+        if self.cursors is None:
+            return options
+        key = [method, name, [list(p) for p in options.params]]
+        md = dict(context.invocation_metadata() or ())
+        token = md.get("fhir-cursor")
+        if token is not None:
+            rows = md.get("fhir-cursor-rows")
+            if rows is not None and not rows.isdigit():
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "fhir-cursor-rows must be a number of rows")
+            try:
+                cursor = self.cursors.resume(token, key, None if rows is None else int(rows))
+            except ValueError as e:
+                context.abort(grpc.StatusCode.OUT_OF_RANGE, "Can't resume the cursor: %s" % (e))
+            if cursor is None:
+                context.abort(grpc.StatusCode.NOT_FOUND, "Unknown or expired cursor for this request")
+        else:
+            cursor = self.cursors.new(key)
+        context.send_initial_metadata((("fhir-cursor", cursor.token),))
+        return options._replace(cursor=cursor)
+
+    def _edges(self, t, options=NO_OPTIONS):
+        """Yields (src_id, dst type, dst_id) for every edge in a table"""
+        if self._indexed(t.src, t.edge) and not options.params:
+            yield from self.edge_index.edges(t.src, t.edge, t.dst if t.typed else None)
+            return
+        if self.shared_scans is not None and not options.params and options.limit is None:
+            for i, r in self._shared_scan(t.src):
+                for _, _, dst_id in edge_refs(t, r.get(t.edge, [])):
+                    yield i, t.dst, dst_id
+            return
+        for i, field in self.fhir.scan_nonempty_field(t.src, t.edge, options):
+            for _, _, dst_id in edge_refs(t, field):
+                yield i, t.dst, dst_id
+
+    def _shared_scan(self, src):
+        """Join the running pass over a source type, or start one, reading
+        the reference fields of every edge table of the type"""
+        with self.shared_lock:
+            for k in [k for k, v in self.shared_scans.items() if k != src and not v.joinable()]:
+                del self.shared_scans[k]
+            scan = self.shared_scans.get(src)
+            reader = scan.join() if scan is not None else None
+            if reader is None:
+                fields = sorted(set(e for s, e in self.schema.get_edge_fields() if s == src))
+                scan = SharedScan(self.fhir.list_resource(src, fields), self.shared_buffer, self.shared_ttl)
+                self.shared_scans[src] = scan
+                reader = scan.start()
+        return reader
 
+    @metrics.instrument_rpc
     def GetIDs(self, request, context):
+        options = self._cursor("GetIDs", request.name, context, self._search_options(context))
         if request.name.endswith(":edges"):
-            src, edge, _ = request.name.split(":")
-            dst = self.schema.get_dst(src, edge)
-            for i, field in self.fhir.scan_nonempty_field(src, edge):
-                for f in force_list(field):
-                    dst_id = f['reference'].split("/")[1]
-                    o = gripper_pb2.RowID()
-                    o.id = edgeID(src,edge,dst,i,dst_id)
-                    yield o
+            t = self._edge_table(request.name, context)
+            rows = (gripper_pb2.RowID(id=edgeID(t.src,t.edge,dst,i,dst_id))
+                for i, dst, dst_id in self._edges(t, options))
         else:
-            for i,e in self.fhir.list_resource(request.name):
-                o = gripper_pb2.RowID()
-                o.id = i
-                yield o
+            rows = (gripper_pb2.RowID(id=i)
+                for i, e in self.fhir.list_resource(request.name, ["id"], options))
+        rows = limit_rows(rows, options)
+        if options.cursor is not None:
+            rows = options.cursor.counted(rows)
+        for o in rows:
+            yield o
 
+    @metrics.instrument_rpc
     def GetRows(self, request, context):
+        options = self._cursor("GetRows", request.name, context, self._search_options(context))
         if request.name.endswith(":edges"):
-            src, edge, _ = request.name.split(":")
-            dst = self.schema.get_dst(src, edge)
-            for i, field in self.fhir.scan_nonempty_field(src, edge):
-                for f in force_list(field):
-                    dst_id = f['reference'].split("/")[1]
-                    o = gripper_pb2.Row()
-                    o.id = edgeID(src,edge,dst,i,dst_id)
-                    json_format.ParseDict({src : i, dst : dst_id}, o.data)
-                    yield o
+            t = self._edge_table(request.name, context)
+            rows = (edgeRow(t.src,t.edge,dst,i,dst_id) for i, dst, dst_id in self._edges(t, options))
         else:
-            for i,e in self.fhir.list_resource(request.name):
-                o = gripper_pb2.Row()
-                o.id = i
-                json_format.ParseDict(e, o.data)
-                yield o
+            rows = (encode_row(i, e) for i, e in self.fhir.list_resource(request.name, options=options))
+        rows = limit_rows(rows, options)
+        if options.cursor is not None:
+            rows = options.cursor.counted(rows)
+        for o in rows:
+            yield o
 
+    @metrics.instrument_rpc
     def GetRowsByID(self, request_iterator, context):
-        for req in request_iterator:
-            if req.collection.endswith(":edges"):
-                # technically, the edge ID has all the information in the edge
-                # table, but we check the record to make sure it exists
-                src, edge, dst = req.id.split(":")
-                srcRes, srcId = src.split("/")
-                d = self.fhir.get_entry(srcRes, srcId)
-                if edge in d:
-                    for j in force_list(d[edge]):
-                        eDst = j['reference']
-                        if dst == eDst:
-                            dstRes, dstId = dst.split("/")
-                            o = gripper_pb2.Row()
-                            o.id = req.id
-                            o.requestID = req.requestID
-                            json_format.ParseDict({srcRes : srcId, dstRes : dstId}, o.data)
-                            yield o
+        batches = batch_requests(request_iterator, self.batch_size, self.batch_window)
+        try:
+            if self.lookup_concurrency > 1:
+                resolve = lambda collection, reqs: list(self._rows_by_id(collection, reqs))
+                for rows in unordered_map(resolve, batches, self.lookup_pool, self.lookup_concurrency):
+                    for o in rows:
+                        yield o
             else:
-                d = self.fhir.get_entry(req.collection, req.id)
-                o = gripper_pb2.Row()
-                o.id = req.id
-                o.requestID = req.requestID
-                json_format.ParseDict(d, o.data)
-                yield o
+                for collection, reqs in batches:
+                    for o in self._rows_by_id(collection, reqs):
+                        yield o
+        except UnknownEdgeTable as e:
+            context.abort(grpc.StatusCode.NOT_FOUND, "Unknown edge table: %s" % (e.args[0]))
+
+    def _rows_by_id(self, collection, reqs):
+        if collection.endswith(":edges"):
+            t = self.schema.edge_table(collection)
+            edges = []
+            for req in reqs:
+                e = parse_edge_id(t, req.id)
+                if e is not None:
+                    edges.append((req, e))
+            if self.edge_id_mode != "trust":
+                # the edge ID has all the information in the edge table, but
+                # the records are checked to make sure the edge exists
+                found = self._existing_edges(t, set(e[0] for _, e in edges))
+                edges = [(req, e) for req, e in edges if e in found]
+            for req, (srcId, dstRes, dstId) in edges:
+                yield encode_edge_row(req.id, t.src, srcId, dstRes, dstId, req.requestID)
+        else:
+            docs = self.fhir.get_entries(collection, set(req.id for req in reqs))
+            for req in reqs:
+                d = docs.get(req.id)
+                if d is not None:
+                    yield encode_row(req.id, d, req.requestID)
+
+    def _existing_edges(self, t, srcIds):
+        """Set of (src id, dst type, dst id) of the edges of a group of
+        source records"""
+        if self.edge_id_mode == "verify" and self._indexed(t.src, t.edge):
+            return set((srcId, dstRes, dstId) for srcId in srcIds
+                for _, dstRes, dstId in self.edge_index.by_src(t.src, t.edge, srcId))
+        if self.edge_id_mode == "verify":
+            docs = self.fhir.get_elements(t.src, srcIds, [t.edge])
+        else:
+            docs = self.fhir.get_entries(t.src, srcIds)
+        return set((srcId, dstRes, dstId) for srcId, d in docs.items()
+            for _, dstRes, dstId in edge_refs(t, d.get(t.edge, [])))
 
+    @metrics.instrument_rpc
     def GetRowsByField(self, req, context):
-        field = re.sub( r'^\$\.', '', req.field) # should be doing full json path, but this will work for now
+        field = re.sub( r'^\$\.', '', req.field)
+        # comma separated values are looked up together, as a FHIR search would
+        values = req.value.split(",")
+        options = self._search_options(context)
         if req.collection.endswith(":edges"):
-            #print("Getting: %s" % (req))
+            self._edge_table(req.collection, context)
+        # calls with their own limit or search parameters are sent on their own
+        merge = not options.params and options.limit is None
+        if self.coalescer is not None and merge and self._coalesce(req.collection, field):
+            rows = self.coalescer.get(req.collection, field, values)
+        else:
+            rows = (o for o, _ in self._rows_by_field(req.collection, field, values, options, match=False))
+        for o in limit_rows(rows, options):
+            yield o
+
+    def _coalesce(self, collection, field):
+        """Lookups answered locally, by the edge index or the mirror, are not
+        worth merging"""
+        if collection.endswith(":edges"):
+            t = self.schema.edge_table(collection)
+            if self._indexed(t.src, t.edge):
+                return False
+            return not self.fhir.searches_locally(t.src, "_id" if field == t.src else t.edge)
+        param = self.fhir.search_param(collection, field)
+        if param is None:
+            return True
+        if self.fhir.searches_locally(collection, param):
+            return False
+        # only exact matches can be told apart in a merged result
+        return ":" not in param and (param == "_id" or self.fhir.param_type(collection, param) in EXACT_TYPES)
+
+    def _rows_by_field(self, collection, field, values, options=NO_OPTIONS, match=True):
+        """Rows matching any of `values` on a field, each paired with the set
+        of values it matched. The set is empty when that can't be told from
+        the record. Without `match` the set is None for rows of a search,
+        where working it out would cost more than encoding the row"""
+        if collection.endswith(":edges"):
             # edge tables are 'created' from scanning the source resource type
-            srcRes, edge, _ = req.collection.split(":")
-            dstRes = self.schema.get_dst(srcRes, edge)
+            t = self.schema.edge_table(collection)
+            srcRes, edge, dstRes = t.src, t.edge, t.dst
+            dstFilter = dstRes if t.typed else None
+            if self._indexed(srcRes, edge) and not options.params:
+                for value in values:
+                    if field == srcRes:
+                        found = self.edge_index.by_src(srcRes, edge, value, dstFilter)
+                    elif field == dstRes:
+                        found = self.edge_index.by_dst(srcRes, edge, value.split("/")[-1], dstFilter)
+                    else:
+                        found = []
+                    for srcId, eDstRes, dstId in found:
+                        yield edgeRow(srcRes,edge,eDstRes,srcId,dstId), {value}
+                return
             if field == srcRes:
-                # if they are scanning from the src side, just get the entry and
-                # return the record
-                srcId = req.value
-                d = self.fhir.get_entry(srcRes, srcId)
-                if edge in d:
-                    for j in force_list(d[edge]):
-                        eDst = j['reference']
-                        dstRes, dstId = eDst.split("/")
-                        o = gripper_pb2.Row()
-                        o.id = edgeID(srcRes,edge,dstRes,srcId,dstId)
-                        json_format.ParseDict({srcRes : srcId, dstRes : dstId}, o.data)
-                        yield o
+                # if they are scanning from the src side, only the edge field
+                # of the source records is needed
+                if self.prefetch_endpoints:
+                    target = "%s:%s" % (srcRes, edge)
+                    if t.typed:
+                        target += ":" + dstRes
+                    docs = self._joined(srcRes, "match", [("_id", ",".join(values)), ("_include", target)],
+                        options=options)
+                elif options.params:
+                    # the search parameters of the call filter the source records
+                    docs = self.fhir.scan_resource(srcRes, "_id", ",".join(values), [edge], options)
+                else:
+                    docs = self.fhir.get_elements(srcRes, values, [edge]).items()
+                for srcId, d in docs:
+                    for _, eDstRes, dstId in edge_refs(t, d.get(edge, [])):
+                        yield edgeRow(srcRes,edge,eDstRes,srcId,dstId), {srcId}
             elif field == dstRes:
                 # if they are scanning from the dst side, look for records that
-                # have the dest in the edge field
-                for srcId, d in self.fhir.scan_resource(srcRes, edge, req.value):
-                    if edge in d:
-                        for j in force_list(d[edge]):
-                            eDst = j['reference']
-                            dstRes, dstId = eDst.split("/")
-                            o = gripper_pb2.Row()
-                            o.id = edgeID(srcRes,edge,dstRes,srcId,dstId)
-                            json_format.ParseDict({srcRes : srcId, dstRes : dstId}, o.data)
-                            yield o
+                # have the dest in the edge field. Tables of a polymorphic edge
+                # use the type modifier, `edge:Dst=id`. The search parameters
+                # of the call are for the source type, so can't be added to a
+                # search of the destinations
+                if self.prefetch_endpoints and not options.params:
+                    docs = self._joined(dstRes, "include",
+                        [("_id", ",".join(v.split("/")[-1] for v in values)),
+                         ("_revinclude", "%s:%s" % (srcRes, edge))], srcRes, options)
+                elif t.typed:
+                    docs = self.fhir.scan_resource(srcRes, "%s:%s" % (edge, dstRes),
+                        ",".join(v.split("/")[-1] for v in values), [edge], options)
+                else:
+                    docs = self.fhir.scan_resource(srcRes, edge, ",".join(values), [edge], options)
+                for srcId, d in docs:
+                    for eDst, eDstRes, dstId in edge_refs(t, d.get(edge, [])):
+                        matched = set(v for v in values if v == eDst or v == dstId)
+                        if matched:
+                            yield edgeRow(srcRes,edge,eDstRes,srcId,dstId), matched
         else:
-            for i,e in self.fhir.scan_resource(req.collection, field, req.value):
-                o = gripper_pb2.Row()
-                o.id = i
-                json_format.ParseDict(e, o.data)
-                yield o
+            values = set(values)
+            param = self.fhir.search_param(collection, field)
+            if param is None:
+                # no search parameter reads this path, so the collection is
+                # scanned and filtered here. The limit applies to the matches,
+                # not to the pages read
+                for i, e in self.fhir.list_resource(collection, options=options._replace(limit=None)):
+                    matched = set(search_values(path_values(e, field))) & values
+                    if matched:
+                        yield encode_row(i, e), matched
+                return
+            paths = self.fhir.param_paths(collection, param) if match else None
+            for i,e in self.fhir.scan_resource(collection, param, ",".join(values), options=options):
+                yield encode_row(i, e), matched_values(e, paths, values) if match else None
+
+def serialize_row(row):
+    """Rows are handed to gRPC already serialized by struct_codec"""
+    if isinstance(row, bytes):
+        return row
+    return row.SerializeToString()
 
-def serve(port, fhir, schema):
+def add_servicer_to_server(servicer, server):
+    """Same as gripper_pb2_grpc.add_GRIPSourceServicer_to_server, but Row
+    responses may be pre-serialized bytes"""
+    rpc_method_handlers = {
+        'GetCollections': grpc.unary_stream_rpc_method_handler(
+            servicer.GetCollections,
+            request_deserializer=gripper_pb2.Empty.FromString,
+            response_serializer=gripper_pb2.Collection.SerializeToString),
+        'GetCollectionInfo': grpc.unary_unary_rpc_method_handler(
+            servicer.GetCollectionInfo,
+            request_deserializer=gripper_pb2.Collection.FromString,
+            response_serializer=gripper_pb2.CollectionInfo.SerializeToString),
+        'GetIDs': grpc.unary_stream_rpc_method_handler(
+            servicer.GetIDs,
+            request_deserializer=gripper_pb2.Collection.FromString,
+            response_serializer=gripper_pb2.RowID.SerializeToString),
+        'GetRows': grpc.unary_stream_rpc_method_handler(
+            servicer.GetRows,
+            request_deserializer=gripper_pb2.Collection.FromString,
+            response_serializer=serialize_row),
+        'GetRowsByID': grpc.stream_stream_rpc_method_handler(
+            servicer.GetRowsByID,
+            request_deserializer=gripper_pb2.RowRequest.FromString,
+            response_serializer=serialize_row),
+        'GetRowsByField': grpc.unary_stream_rpc_method_handler(
+            servicer.GetRowsByField,
+            request_deserializer=gripper_pb2.FieldRequest.FromString,
+            response_serializer=serialize_row),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+        'gripper.GRIPSource', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+def serve(port, fhir, schema, config={}):
+    if "METRICS_PORT" in config:
+        metrics.watch_client(fhir)
+        metrics.start_http_server(config["METRICS_PORT"])
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=100))
-    gripper_pb2_grpc.add_GRIPSourceServicer_to_server(
-      FHIRServicer(fhir, schema), server)
+    add_servicer_to_server(FHIRServicer(fhir, schema, config), server)
     server.add_insecure_port('[::]:%s' % port)
+    # `kill -HUP` reloads the CapabilityStatement, the GRIPSource service
+    # has no admin calls to do it over gRPC
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+            threading.Thread(target=fhir.update_metadata, daemon=True).start())
     server.start()
     print("Serving: %s" % (port))
     server.wait_for_termination()
@@ -283,6 +1696,10 @@ if __name__ == "__main__":
         config = yaml.load(handle, Loader=yaml.SafeLoader)
     with open(sys.argv[2]) as handle:
         schemaConfig = yaml.load(handle, Loader=yaml.SafeLoader)
-    client = FHIRClient(config)
     schema = Schema(schemaConfig)
-    serve(config.get("PORT",50051), client, schema)
+    if config.get("ASYNC", False):
+        import async_server
+        async_server.serve(config.get("PORT",50051), config, schema)
+    else:
+        client = FHIRClient(config)
+        serve(config.get("PORT",50051), client, schema, config)